@@ -6,9 +6,10 @@ Created on Feb 23, 2017
 from __future__ import print_function, division
 import sys
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 import numpy as np
-import multiprocessing as mp
-import h5py
+import psutil
 import PIL
 
 try:
@@ -40,6 +41,10 @@ except ImportError as ex:
 
 from .dpc_kernel import main as dpc_kernel_main
 from .dpc_kernel import load_image_filestore
+from .dpc_kernel import load_frames_hdf5, project_hdf5, cached_projections, detector_shape_hdf5
+from .dpc_kernel import make_executor, SerialExecutor, HDF5_BUDGET_MB, set_hdf5_max_open_files
+from .dpc_kernel import fit_settings_hash, load_checkpoint
+from .dpc_kernel import recon_maps, recon_mode, load_raw_results, rescale_results, RAW_SETTINGS
 
 version = "0.1.0"
 
@@ -104,25 +109,12 @@ def set_scan_from_scaninfo(scan):
     return dx, dy, cols, rows, pyramid_scan
 
 
-def load_data_hdf5(path):
+def load_image_hdf5(path, frame=0):
     """
-    Read images using the h5py lib
+    Read one frame of the detector stack; the file is kept open for the
+    next frames
     """
-    f = h5py.File(str(path), "r")
-    entry = f["entry"]
-    instrument = entry["instrument"]
-    detector = instrument["detector"]
-    dsdata = detector["data"]
-    data = dsdata[...]
-
-    return np.array(data)
-
-
-def load_image_hdf5(path):
-
-    data = load_data_hdf5(path)
-
-    return data[0, :, :]
+    return load_frames_hdf5(path, frame)
 
 
 def save_results(
@@ -149,23 +141,23 @@ def save_results(
 
         if save_pngs:
             a_path = save_filename + "_a.png"
-            im = PIL.Image.fromarray((2.0 / a.ptp() * (a - a.min())).astype(np.uint8))
+            im = PIL.Image.fromarray((2.0 / np.ptp(a) * (a - a.min())).astype(np.uint8))
             im.save(a_path)
             gx_path = save_filename + "_gx.png"
-            im = PIL.Image.fromarray((255.0 / gx.ptp() * (gx - gx.min())).astype(np.uint8))
+            im = PIL.Image.fromarray((255.0 / np.ptp(gx) * (gx - gx.min())).astype(np.uint8))
             im.save(gx_path)
             gy_path = save_filename + "_gy.png"
-            im = PIL.Image.fromarray((255.0 / gy.ptp() * (gy - gy.min())).astype(np.uint8))
+            im = PIL.Image.fromarray((255.0 / np.ptp(gy) * (gy - gy.min())).astype(np.uint8))
             im.save(gy_path)
             rx_path = save_filename + "_rx.png"
-            im = PIL.Image.fromarray((255.0 / rx.ptp() * (rx - rx.min())).astype(np.uint8))
+            im = PIL.Image.fromarray((255.0 / np.ptp(rx) * (rx - rx.min())).astype(np.uint8))
             im.save(rx_path)
             ry_path = save_filename + "_ry.png"
-            im = PIL.Image.fromarray((255.0 / ry.ptp() * (ry - ry.min())).astype(np.uint8))
+            im = PIL.Image.fromarray((255.0 / np.ptp(ry) * (ry - ry.min())).astype(np.uint8))
             im.save(ry_path)
             if phi is not None:
                 phi_path = save_filename + "_phi.png"
-                im = PIL.Image.fromarray((255.0 / phi.ptp() * (phi - phi.min())).astype(np.uint8))
+                im = PIL.Image.fromarray((255.0 / np.ptp(phi) * (phi - phi.min())).astype(np.uint8))
                 im.save(phi_path)
 
         if save_tif and havetiff:
@@ -231,6 +223,25 @@ def init_scan_parameters():
         "scan": None,
         "save_path": None,
         "pad": False,
+        "recon_tol": 1e-3,
+        "recon_max_iters": 50,
+        "phase_corr_init": -1,
+        "neighbor_start": -1,
+        "processing_mode": "Fourier-shift",
+        "use_shared_memory": -1,
+        "hdf5_budget_mb": HDF5_BUDGET_MB,
+        "read_in_workers": -1,
+        "chunksize": 0,
+        "max_inflight": 0,
+        "executor": "processes",
+        "pipeline": -1,
+        "concurrent_scans": 1,
+        "memory_limit_mb": 0,
+        "checkpoint": -1,
+        "checkpoint_interval": 60.0,
+        "result_cache": -1,
+        "save_raw": -1,
+        "projection_cache": -1,
     }
 
     return scan_parameters
@@ -267,7 +278,7 @@ def read_scan_parameters_from_file(scan_parameters, param_filename):
 
             elif "pixel_size_um" in line.lower():
                 slist = line.strip().split("=")
-                scan_parameters["pixel_size_um"] = float(slist[1])
+                scan_parameters["pixel_size"] = float(slist[1])
 
             elif "detector_sample_distance" in line.lower():
                 slist = line.strip().split("=")
@@ -305,6 +316,10 @@ def read_scan_parameters_from_file(scan_parameters, param_filename):
                 slist = line.strip().split("=")
                 scan_parameters["solver"] = slist[1].strip()
 
+            elif "processing_mode" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["processing_mode"] = slist[1].strip()
+
             elif "random" in line.lower():
                 slist = line.strip().split("=")
                 scan_parameters["random"] = int(slist[1])
@@ -329,9 +344,82 @@ def read_scan_parameters_from_file(scan_parameters, param_filename):
                 slist = line.strip().split("=")
                 scan_parameters["reverse_y"] = int(slist[1])
 
+            elif "phase_corr_init" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["phase_corr_init"] = int(slist[1])
+
+            elif "neighbor_start" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["neighbor_start"] = int(slist[1])
+
+            elif "use_shared_memory" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["use_shared_memory"] = int(slist[1])
+
+            elif "hdf5_budget_mb" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["hdf5_budget_mb"] = int(slist[1])
+
+            elif "read_in_workers" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["read_in_workers"] = int(slist[1])
+
+            elif "chunksize" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["chunksize"] = int(slist[1])
+
+            elif "max_inflight" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["max_inflight"] = int(slist[1])
+
+            elif "executor" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["executor"] = slist[1].strip()
+
+            elif "pipeline" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["pipeline"] = int(slist[1])
+
+            elif "concurrent_scans" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["concurrent_scans"] = int(slist[1])
+
+            elif "memory_limit_mb" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["memory_limit_mb"] = int(slist[1])
+
+            elif "projection_cache" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["projection_cache"] = int(slist[1])
+
+            elif "save_raw" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["save_raw"] = int(slist[1])
+
+            elif "result_cache" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["result_cache"] = int(slist[1])
+
+            elif "checkpoint_interval" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["checkpoint_interval"] = float(slist[1])
+
+            elif "checkpoint" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["checkpoint"] = int(slist[1])
+
+            elif "recon_tol" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["recon_tol"] = float(slist[1])
+
+            elif "recon_max_iters" in line.lower():
+                slist = line.strip().split("=")
+                scan_parameters["recon_max_iters"] = int(slist[1])
+
             elif "pad" in line.lower():
+                # a name in RECON_MODES, or 1 to pad the Fourier integration
                 slist = line.strip().split("=")
-                scan_parameters["pad"] = int(slist[1])
+                scan_parameters["pad"] = recon_mode(slist[1])
 
             elif "bad_pixels" in line.lower():
                 slist = line.strip().split("=")
@@ -519,6 +607,389 @@ def parse_script(script_file):
 """ ------------------------------------------------------------------------------------------------"""
 
 
+def raw_results_file(save_path, save_filename, scan_number):
+    """File of the raw results of a scan of the batch"""
+    return os.path.join(save_path, "S{0}_{1}_raw.npz".format(scan_number, save_filename))
+
+
+def get_scan_numbers(scan_range, scan_numbers, every_nth_scan=1):
+    """Scan numbers of a batch script: its scan numbers, then its scan ranges"""
+    calc_scan_numbers = np.array((), dtype=int)
+    calc_scan_numbers = np.append(calc_scan_numbers, np.array(scan_numbers, dtype=int))
+    # Get scan numbers from the range
+    for item in scan_range:
+        calc_scan_numbers = np.append(
+            calc_scan_numbers, np.arange(item[0], item[1] + 1, every_nth_scan, dtype=int)
+        )
+    return calc_scan_numbers
+
+
+def prepare_scan(
+    scan_number,
+    dpc_settings,
+    scan_parameters,
+    data_directory,
+    file_format,
+    get_data_from_datastore=0,
+    file_store_key="",
+    read_params_from_datastore=0,
+    save_path="",
+    save_filename="results",
+):
+    """
+    Settings of ``dpc_kernel.main`` for one scan of the batch
+
+    With the ``checkpoint`` scan parameter, the partial results of the scan
+    are checkpointed next to its results, and a rerun of the batch resumes
+    from them: only the missing scan points, or scans, are fitted.
+
+    With the ``result_cache`` scan parameter, ``settings["result_cache"]``
+    is the entry of the scan in the result cache, see ``fit_scan``.
+
+    With the ``save_raw`` scan parameter, the raw results of the scan are
+    saved next to its results, see ``run_rescale``.
+
+    With the ``projection_cache`` scan parameter, the projections of the
+    frames of an HDF5 scan are saved to a sidecar next to its results, and
+    later runs fit them from there without reading the scan file, e.g. with
+    another solver or start point; see ``dpc_kernel.cached_projections``.
+
+    Returns
+    ----------
+    scan_number : int
+    settings : dict
+        copy of ``dpc_settings`` completed for the scan, including
+        ``load_image``
+    """
+    settings = dict(dpc_settings)
+
+    scan_filename = os.path.join(data_directory, file_format.format(scan_number))
+    print("\nProcessing scan number ", scan_number)
+
+    settings["file_format"] = scan_filename
+    settings["ref_image"] = scan_filename
+    settings["scan"] = scan_number
+
+    if scan_parameters["checkpoint"] == 1:
+        settings["checkpoint"] = os.path.join(
+            save_path or data_directory, "S{0}_{1}_checkpoint.npz".format(scan_number, save_filename)
+        )
+        settings["checkpoint_interval"] = scan_parameters["checkpoint_interval"]
+
+    if scan_parameters["save_raw"] == 1:
+        settings["raw_results"] = raw_results_file(save_path or data_directory, save_filename, scan_number)
+
+    if get_data_from_datastore:
+        settings["load_image"] = load_image_filestore
+        settings["file_format"] = ""
+        settings["ref_image"] = ""
+        settings["use_hdf5"] = False
+        settings["use_mds"] = True
+
+        try:
+            scan_id = int(scan_number)
+            mds_scan = load_scan_from_mds(scan_id)
+        except Exception as ex:
+            print("Filestore load failed (datum={}): ({}) {}" "".format(scan_number, ex.__class__.__name__, ex))
+            raise
+        mds_scan.key = file_store_key
+
+        settings["scan"] = mds_scan
+
+        settings["ref_image"] = get_ref_from_mds(mds_scan, scan_parameters["first_image"], file_store_key)
+
+        if read_params_from_datastore == 1:
+            dx, dy, cols, rows, pyramid_scan = set_scan_from_scaninfo(mds_scan)
+            settings["dx"] = dx
+            settings["dy"] = dy
+            settings["rows"] = rows
+            settings["cols"] = cols
+            settings["pyramid"] = pyramid_scan
+
+    else:
+        print("\nProcessing scan ", scan_filename)
+        settings["load_image"] = load_image_hdf5
+        settings["use_hdf5"] = True
+        # frames of the HDF5 stack are numbered from 1 in dpc_kernel
+        settings["first_image"] = scan_parameters["first_image"] + 1
+        if scan_parameters["projection_cache"] == 1:
+            settings["projection_cache"] = os.path.join(
+                save_path or data_directory, "S{0}_projections.h5".format(scan_number)
+            )
+
+    if scan_parameters["result_cache"] == 1:
+        # the settings hash covers the size and modification time of the
+        # data file
+        key = fit_settings_hash(settings, scan_number=int(scan_number), use_mds=settings["use_mds"])
+        settings["result_cache"] = os.path.join(save_path or data_directory, "dpc_cache", key + ".npz")
+
+    return scan_number, settings
+
+
+def prefetch_scan(job):
+    """
+    Read the projections of the frames of an HDF5 scan, which ``main``
+    otherwise reads itself when the scan is started
+    """
+    scan_number, settings = job
+    if os.path.exists(settings.get("result_cache") or ""):
+        # not fitted again, see fit_scan
+        return job
+
+    if settings.get("checkpoint"):
+        restored = load_checkpoint(
+            settings["checkpoint"], fit_settings_hash(settings), (settings["rows"], settings["cols"])
+        )
+        if restored is not None and restored[0].any():
+            # resumed: main reads the frames of the missing points only
+            return job
+
+    if (
+        settings["use_hdf5"]
+        and settings["processing_mode"] == "Fourier-shift"
+        and settings["use_shared_memory"] != 1
+        and settings["read_in_workers"] != 1
+    ):
+        roi = None
+        if None not in (settings["x1"], settings["y1"], settings["x2"], settings["y2"]):
+            roi = (settings["x1"], settings["y1"], settings["x2"], settings["y2"])
+        first = settings["first_image"] - 1
+        stop = first + settings["rows"] * settings["cols"]
+        bad_pixels = settings.get("bad_pixels", [])
+        if settings.get("projection_cache"):
+            settings["projections"] = cached_projections(
+                settings["projection_cache"],
+                settings["file_format"],
+                first,
+                stop,
+                roi=roi,
+                bad_pixels=bad_pixels,
+                budget_mb=settings["hdf5_budget_mb"],
+            )
+        else:
+            settings["projections"] = project_hdf5(
+                settings["file_format"],
+                first,
+                stop,
+                roi=roi,
+                bad_pixels=bad_pixels,
+                budget_mb=settings["hdf5_budget_mb"],
+            )
+
+    return scan_number, settings
+
+
+def read_ahead(jobs, depth=1):
+    """
+    Prefetch stage of the batch pipeline: yields the jobs of ``prepare_scan``
+    once ``prefetch_scan`` has read them in a background thread, at most
+    ``depth`` scans ahead of the consumer
+    """
+    with ThreadPoolExecutor(1) as reader:
+        pending = deque()
+        for job in jobs:
+            pending.append(reader.submit(prefetch_scan, job))
+            if len(pending) > depth:
+                yield pending.popleft().result()
+
+        while pending:
+            yield pending.popleft().result()
+
+
+def scan_frame_bytes(settings):
+    """
+    Bytes of one detector frame of a scan and of its float64 projections,
+    0 and 0 when the frames are not known before the fit
+    """
+    # a scan file which no longer exists is fitted from its projection
+    # sidecar, whose size is negligible
+    if not settings["use_hdf5"] or not os.path.exists(settings["file_format"]):
+        return 0, 0
+    shape, dtype = detector_shape_hdf5(settings["file_format"])
+    return int(np.prod(shape[1:])) * dtype.itemsize, 8 * (shape[1] + shape[2])
+
+
+def scan_memory(settings):
+    """
+    Estimated peak memory of ``dpc_kernel.main`` for a scan, in bytes, and
+    its number of tasks
+    """
+    rows, cols = settings["rows"], settings["cols"]
+    n_frames = rows * cols
+    chunksize = settings["chunksize"] or cols
+    tasks = rows * -(-cols // chunksize)
+
+    # result maps, and the padded reconstruction
+    memory = 640 * n_frames
+
+    frame_bytes, line_bytes = scan_frame_bytes(settings)
+    memory += n_frames * line_bytes
+    in_workers = settings["use_shared_memory"] == 1 or settings["read_in_workers"] == 1
+    if settings["use_shared_memory"] == 1:
+        memory += n_frames * frame_bytes
+    elif settings["read_in_workers"] != 1:
+        memory += min(settings["hdf5_budget_mb"] * 2**20, n_frames * frame_bytes)
+
+    # the tasks in flight hold their frames when the workers read them, and
+    # a copy of their projections otherwise
+    window = min(settings["max_inflight"] or tasks, tasks) * chunksize
+    memory += window * (frame_bytes if in_workers else line_bytes)
+
+    return memory, tasks
+
+
+def size_scan(settings, memory_share, max_inflight):
+    """
+    Size the HDF5 reads and the tasks in flight of a scan after its frames,
+    so that its estimated memory (``scan_memory``) fits in ``memory_share``
+    bytes where possible
+
+    The reads of the main process get at most a quarter of the share, and
+    the tasks in flight the rest of it. Scans with larger frames get shorter
+    tasks (``chunksize``) first, and then fewer of them in flight, down to
+    one frame. ``max_inflight`` is the share of the workers of the scan;
+    values set in the parameter file are upper bounds.
+    """
+    rows, cols = settings["rows"], settings["cols"]
+    frame_bytes, line_bytes = scan_frame_bytes(settings)
+    in_workers = settings["use_shared_memory"] == 1 or settings["read_in_workers"] == 1
+
+    if frame_bytes and not in_workers:
+        budget = min(settings["hdf5_budget_mb"] * 2**20, memory_share / 4, rows * cols * frame_bytes)
+        settings["hdf5_budget_mb"] = max(budget, frame_bytes) / 2**20
+
+    if settings["max_inflight"]:
+        max_inflight = min(settings["max_inflight"], max_inflight)
+    task_frame_bytes = frame_bytes if in_workers else line_bytes
+    if task_frame_bytes:
+        base, _ = scan_memory(dict(settings, chunksize=1, max_inflight=1))
+        window = max(memory_share - base, 0) // task_frame_bytes
+        chunksize = min(settings["chunksize"] or cols, max(window // max_inflight, 1))
+        max_inflight = min(max_inflight, max(window // chunksize, 1))
+        if chunksize < (settings["chunksize"] or cols):
+            settings["chunksize"] = int(chunksize)
+    settings["max_inflight"] = int(max_inflight)
+
+
+def load_cached_results(cache_path, settings):
+    """
+    Results of a scan from its result cache entry: the fitted maps are
+    stored, and the phase is reconstructed again from them
+    """
+    with np.load(cache_path) as data:
+        a, gx, gy, rx, ry = [data[name] for name in ("a", "gx", "gy", "rx", "ry")]
+    # the residuals of the fits of gx and gy
+    res_x, res_y = (ry, rx) if settings["swap"] == 1 else (rx, ry)
+    phi = recon_maps(
+        gx,
+        gy,
+        settings["dx"],
+        settings["dy"],
+        settings["pad"],
+        res_x,
+        res_y,
+        a,
+        settings["recon_tol"],
+        settings["recon_max_iters"],
+    )
+    return a, gx, gy, phi, rx, ry
+
+
+def save_cached_results(cache_path, results):
+    """Store the fitted maps of a scan in its result cache entry"""
+    a, gx, gy, phi, rx, ry = results
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    tmp_path = cache_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, a=a, gx=gx, gy=gy, rx=rx, ry=ry)
+    os.replace(tmp_path, cache_path)
+
+
+def fit_scan(scan_number, settings):
+    """
+    Fitting stage of the batch for one scan
+
+    A scan with an entry in the result cache, i.e. with unchanged data and
+    fit settings, is not fitted again.
+    """
+    cache_path = settings.pop("result_cache", None)
+    if cache_path is not None and os.path.exists(cache_path):
+        try:
+            results = load_cached_results(cache_path, settings)
+            print("Scan {0} is unchanged, using the cached results {1}".format(scan_number, cache_path))
+            return scan_number, results
+        except Exception as ex:
+            print("Failed to load cached results {0}: ({1}) {2}".format(cache_path, ex.__class__.__name__, ex))
+
+    results = dpc_kernel_main(display_fcn=None, **settings)
+    if cache_path is not None:
+        try:
+            save_cached_results(cache_path, results)
+        except Exception as ex:
+            print("Failed to cache results {0}: ({1}) {2}".format(cache_path, ex.__class__.__name__, ex))
+    return scan_number, results
+
+
+def fit_scans(jobs, workers=1, concurrent_scans=1, memory_limit_mb=0):
+    """
+    Fitting stage of the batch: runs ``dpc_kernel.main`` for the jobs of
+    ``prepare_scan``, several scans at a time
+
+    A scan is started when no scan runs, or when
+
+    - fewer than ``concurrent_scans`` scans run or, with 0, the running scans
+      have fewer tasks than twice the number of ``workers``, and
+    - its estimated memory (``scan_memory``) and that of the running scans
+      fit in ``memory_limit_mb``, by default 80% of the available memory.
+
+    Concurrent scans share the workers and the memory limit equally; each
+    scan sizes its tasks and its HDF5 reads in its share (``size_scan``).
+
+    Yields
+    ----------
+    scan_number, (a, gx, gy, phi, rx, ry)
+        in completion order
+    """
+    if memory_limit_mb > 0:
+        memory_limit = memory_limit_mb * 2**20
+    else:
+        memory_limit = 0.8 * psutil.virtual_memory().available
+
+    max_scans = concurrent_scans if concurrent_scans > 0 else workers
+    fitter = ThreadPoolExecutor(max_scans) if max_scans > 1 else SerialExecutor()
+    running = {}
+
+    def admits(memory, tasks):
+        if not running:
+            return True
+        elif len(running) >= max_scans:
+            return False
+        elif concurrent_scans <= 0 and sum(t for _, t in running.values()) >= 2 * workers:
+            return False
+        return sum(m for m, _ in running.values()) + memory <= memory_limit
+
+    try:
+        for scan_number, settings in jobs:
+            size_scan(settings, memory_limit / max_scans, max(4 * workers // max_scans, 2))
+            memory, tasks = scan_memory(settings)
+            while not admits(memory, tasks):
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    del running[future]
+                    yield future.result()
+
+            running[fitter.submit(fit_scan, scan_number, settings)] = (memory, tasks)
+            del settings
+
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                del running[future]
+                yield future.result()
+    finally:
+        fitter.shutdown()
+
+
 def run_batch(script_file):
 
     print("Parsing script ", script_file)
@@ -547,13 +1018,7 @@ def run_batch(script_file):
     else:
         print("Reading data from .h5 files.")
 
-    calc_scan_numbers = np.array((), dtype=np.int)
-    calc_scan_numbers = np.append(calc_scan_numbers, np.array(scan_numbers, dtype=np.int))
-    # Get scan numbers from the range
-    for item in scan_range:
-        calc_scan_numbers = np.append(
-            calc_scan_numbers, np.arange(item[0], item[1] + 1, every_nth_scan, dtype=np.int)
-        )
+    calc_scan_numbers = get_scan_numbers(scan_range, scan_numbers, every_nth_scan)
 
     scan_parameters = init_scan_parameters()
 
@@ -584,75 +1049,146 @@ def run_batch(script_file):
         "random": scan_parameters["random"],
         "pyramid": scan_parameters["pyramid"],
         "pad": scan_parameters["pad"],
+        "recon_tol": scan_parameters["recon_tol"],
+        "recon_max_iters": scan_parameters["recon_max_iters"],
         "hang": scan_parameters["hang"],
         "ref_image": scan_parameters["ref_image"],
         "first_image": scan_parameters["first_image"],
         "solver": scan_parameters["solver"],
+        "phase_corr_init": scan_parameters["phase_corr_init"],
+        "neighbor_start": scan_parameters["neighbor_start"],
+        "processing_mode": scan_parameters["processing_mode"],
+        "use_shared_memory": scan_parameters["use_shared_memory"],
+        "hdf5_budget_mb": scan_parameters["hdf5_budget_mb"],
+        "read_in_workers": scan_parameters["read_in_workers"],
+        "chunksize": scan_parameters["chunksize"],
+        "max_inflight": scan_parameters["max_inflight"],
+        "executor": scan_parameters["executor"],
         "scan": None,
         "use_mds": scan_parameters["use_mds"],
         "calculate_results": True,
     }
 
-    n_scans = calc_scan_numbers.size
+    workers = processes if processes > 0 else 1
+
+    # Every scan fitted at once keeps its HDF5 file open, in the workers too
+    concurrent_scans = scan_parameters["concurrent_scans"]
+    set_hdf5_max_open_files(concurrent_scans if concurrent_scans > 0 else workers)
+
+    # One executor, and its workers, for the whole batch; processes = 0 runs
+    # the scans serially
+    dpc_settings["executor"], _ = make_executor(scan_parameters["executor"], processes)
+
+    jobs = (
+        prepare_scan(
+            scan_number,
+            dpc_settings,
+            scan_parameters,
+            data_directory,
+            file_format,
+            get_data_from_datastore,
+            file_store_key,
+            read_params_from_datastore,
+            save_path,
+            save_filename,
+        )
+        for scan_number in calc_scan_numbers
+    )
 
-    for i_scan in range(n_scans):
+    # The pipeline reads the next scan and writes the results of the previous
+    # one in background threads while the current scan is fitted
+    pipeline = scan_parameters["pipeline"] == 1
+    if pipeline:
+        jobs = read_ahead(jobs)
+        writer = ThreadPoolExecutor(1)
+    else:
+        writer = SerialExecutor()
+
+    saves = deque()
+    try:
+        scans = fit_scans(
+            jobs,
+            workers,
+            concurrent_scans=concurrent_scans,
+            memory_limit_mb=scan_parameters["memory_limit_mb"],
+        )
+        for scan_number, (a, gx, gy, phi, rx, ry) in scans:
+            saves.append(
+                writer.submit(
+                    save_results,
+                    a,
+                    gx,
+                    gy,
+                    phi,
+                    rx,
+                    ry,
+                    save_path,
+                    save_filename,
+                    scan_number,
+                    save_pngs=save_pngs,
+                    save_tif=True,
+                    save_txt=save_txt,
+                )
+            )
+            del a, gx, gy, phi, rx, ry
+            while len(saves) > 1:
+                saves.popleft().result()
 
-        scan_filename = os.path.join(data_directory, file_format.format(calc_scan_numbers[i_scan]))
-        print("\nProcessing scan number ", calc_scan_numbers[i_scan])
+        while saves:
+            saves.popleft().result()
+    finally:
+        writer.shutdown()
+        dpc_settings["executor"].shutdown()
 
-        dpc_settings["file_format"] = scan_filename
-        dpc_settings["ref_image"] = scan_filename
-        dpc_settings["scan"] = calc_scan_numbers[i_scan]
+    print("DPC finished")
 
-        if get_data_from_datastore:
-            load_image = load_image_filestore
-            dpc_settings["file_format"] = ""
-            dpc_settings["ref_image"] = ""
-            dpc_settings["use_hdf5"] = False
-            dpc_settings["use_mds"] = True
 
-            try:
-                scan_id = int(calc_scan_numbers[i_scan])
-                mds_scan = load_scan_from_mds(scan_id)
-            except Exception as ex:
-                print(
-                    "Filestore load failed (datum={}): ({}) {}"
-                    "".format(calc_scan_numbers[i_scan], ex.__class__.__name__, ex)
-                )
-                raise
-            mds_scan.key = file_store_key
+""" ------------------------------------------------------------------------------------------------"""
 
-            dpc_settings["scan"] = mds_scan
 
-            dpc_settings["ref_image"] = get_ref_from_mds(mds_scan, scan_parameters["first_image"], file_store_key)
+def run_rescale(script_file):
+    """
+    Regenerate the results of a batch from the raw results it saved with
+    ``save_raw = 1``, for the geometry (pixel size, detector distance,
+    energy), sign, swap and reconstruction settings now in its parameter
+    file; the detector data is not read and nothing is fitted again
+    """
+    print("Parsing script ", script_file)
+    (
+        scan_range,
+        scan_numbers,
+        every_nth_scan,
+        get_data_from_datastore,
+        data_directory,
+        read_params_from_datastore,
+        parameter_file,
+        processes,
+        scan_header_index,
+        file_format,
+        file_store_key,
+        save_path,
+        save_filename,
+        save_pngs,
+        save_txt,
+    ) = parse_script(script_file)
 
-            if read_params_from_datastore == 1:
-                dx, dy, cols, rows, pyramid_scan = set_scan_from_scaninfo(mds_scan)
-                dpc_settings["dx"] = dx
-                dpc_settings["dy"] = dy
-                dpc_settings["rows"] = rows
-                dpc_settings["cols"] = cols
-                dpc_settings["pyramid"] = pyramid_scan
+    scan_parameters = init_scan_parameters()
 
-        else:
-            print("\nProcessing scan ", scan_filename)
-            load_image = load_image_hdf5
-            dpc_settings["use_hdf5"] = True
-
-        if processes == 0:
-            print(
-                "Error - number of processes in myscript.txt is equal to 0. "
-                "Please set to minimum 1 with processes = 1."
-            )
-            exit()
-        else:
-            pool = mp.Pool(processes=processes)
+    try:
+        scan_parameters = read_scan_parameters(scan_parameters, param_filename=parameter_file)
+    except Exception:
+        print("Could not read scan parameters from parameter file {}. Using defaults.".format(parameter_file))
 
-        # Run the analysis
-        a, gx, gy, phi, rx, ry = dpc_kernel_main(
-            pool=pool, display_fcn=None, load_image=load_image, **dpc_settings
-        )
+    for scan_number in get_scan_numbers(scan_range, scan_numbers, every_nth_scan):
+        raw_path = raw_results_file(save_path or data_directory, save_filename, scan_number)
+        try:
+            raw = load_raw_results(raw_path)
+        except IOError:
+            print("No raw results {0} for scan {1}, skipping it".format(raw_path, scan_number))
+            continue
 
+        print("Rescaling scan ", scan_number)
+        a, gx, gy, phi, rx, ry = rescale_results(raw, **{key: scan_parameters[key] for key in RAW_SETTINGS})
         save_results(
             a,
             gx,
@@ -662,16 +1198,13 @@ def run_batch(script_file):
             ry,
             save_path,
             save_filename,
-            calc_scan_numbers[i_scan],
+            scan_number,
             save_pngs=save_pngs,
             save_tif=True,
             save_txt=save_txt,
         )
 
-    print("DPC finished")
-
-
-""" ------------------------------------------------------------------------------------------------"""
+    print("DPC rescaling finished")
 
 
 def run_dpc_script():
@@ -685,5 +1218,16 @@ def run_dpc_script():
     run_batch(script_file)
 
 
+def run_rescale_script():
+
+    try:
+        script_file = sys.argv[1]
+    except Exception:
+        print("Script file is not specified.\nUsage: dpcmaps-rescale <script-file_name>")
+        exit()
+
+    run_rescale(script_file)
+
+
 if __name__ == "__main__":
     run_dpc_script()
@@ -22,6 +22,7 @@ import sys
 import csv
 
 import time
+import re
 import logging
 from datetime import datetime
 from functools import wraps
@@ -93,7 +94,6 @@ except ImportError as ex:
     havetiff = False
 
 import dpcmaps.load_timepix as load_timepix
-import h5py
 import dpcmaps.dpc_kernel as dpc
 import dpcmaps.pyspecfile as pyspecfile
 
@@ -130,6 +130,10 @@ SOLVERS = [
     "SLS-QP",
     "dogleg",
     "trust-ncg",
+    "Levenberg-Marquardt",
+    "Variable-Projection",
+    "Batch-Newton",
+    "Phase-Correlation",
 ]
 
 TYPES = [
@@ -162,26 +166,12 @@ def load_image_pil(path):
     return np.array(f.getdata()).reshape(f.size[::-1])
 
 
-def load_data_hdf5(file_path):
+def load_image_hdf5(file_path, frame=0):
     """
-    Read images using the h5py lib
+    Read one frame of the detector stack; the file is kept open for the
+    next frames
     """
-    f = h5py.File(str(file_path), "r")
-    entry = f["entry"]
-    instrument = entry["instrument"]
-    detector = instrument["detector"]
-    dsdata = detector["data"]
-    data = dsdata[...]
-    f.close()
-
-    return np.array(data)
-
-
-def load_image_hdf5(file_path):
-
-    data = load_data_hdf5(file_path)
-
-    return data[0, :, :]
+    return dpc.load_frames_hdf5(file_path, frame)
 
 
 def load_image_ascii(path):
@@ -251,7 +241,12 @@ class DPCThread(QtCore.QThread):
             main.hanging_opt.setEnabled(True)
             main.random_processing_opt.setEnabled(True)
             main.pyramid_scan.setEnabled(True)
+            main.phase_corr_opt.setEnabled(True)
+            main.neighbor_start_opt.setEnabled(True)
+            main.checkpoint_opt.setEnabled(True)
             main.pad_recon.setEnabled(True)
+            main.dct_recon.setEnabled(True)
+            main.weighted_recon.setEnabled(True)
             # main.direction_btn.setEnabled(True)
             # main.removal_btn.setEnabled(True)
             # main.confirm_btn.setEnabled(True)
@@ -436,6 +431,22 @@ class DPCWindow(QMainWindow):
         for solver in SOLVERS:
             self.solver_widget.addItem(solver)
 
+        self.processing_mode_widget = QComboBox()
+        for mode in dpc.PROCESSING_MODES:
+            self.processing_mode_widget.addItem(mode)
+
+        self.executor_widget = QComboBox()
+        for executor in dpc.EXECUTORS:
+            self.executor_widget.addItem(executor)
+
+        # 0: whole scan rows / automatic
+        self.chunksize_widget = QSpinBox()
+        self.chunksize_widget.setMaximum(100000)
+        self.chunksize_widget.setSpecialValueText("Row")
+        self.max_inflight_widget = QSpinBox()
+        self.max_inflight_widget.setMaximum(100000)
+        self.max_inflight_widget.setSpecialValueText("Auto")
+
         self.start_widget = QPushButton("Start")
         self.stop_widget = QPushButton("Stop")
         self.save_widget = QPushButton("Save")
@@ -685,7 +696,11 @@ class DPCWindow(QMainWindow):
         self.computationParaGridLayout = QGridLayout()
         self.computationParaGbox.setLayout(self.computationParaGridLayout)
         self.solver_method_lbl = QLabel("Solver method")
+        self.processing_mode_lbl = QLabel("Processing mode")
         self.processes_lbl = QLabel("Processes")
+        self.executor_lbl = QLabel("Executor")
+        self.chunksize_lbl = QLabel("Chunk size")
+        self.max_inflight_lbl = QLabel("Max in flight")
         self.random_processing_checkbox = QCheckBox("Random mode")
         self.hanging_checkbox = QCheckBox("Hanging mode")
 
@@ -694,6 +709,14 @@ class DPCWindow(QMainWindow):
         layout.addWidget(self.solver_widget, 0, 1)
         layout.addWidget(self.processes_lbl, 0, 2)
         layout.addWidget(self.processes_widget, 0, 3)
+        layout.addWidget(self.processing_mode_lbl, 1, 0)
+        layout.addWidget(self.processing_mode_widget, 1, 1)
+        layout.addWidget(self.chunksize_lbl, 1, 2)
+        layout.addWidget(self.chunksize_widget, 1, 3)
+        layout.addWidget(self.max_inflight_lbl, 1, 4)
+        layout.addWidget(self.max_inflight_widget, 1, 5)
+        layout.addWidget(self.executor_lbl, 2, 0)
+        layout.addWidget(self.executor_widget, 2, 1)
         # layout.addWidget(self.random_processing_checkbox, 1, 0)
         # layout.addWidget(self.hanging_checkbox, 1, 1)
         layout.addWidget(self.start_widget, 0, 4)
@@ -823,6 +846,13 @@ class DPCWindow(QMainWindow):
         self.pyramid_scan = QAction("Pyramid scan", self, checkable=True)
         self.pad_recon = QAction("Padding mode", self, checkable=True)
         self.pad_recon.triggered.connect(self.padding_recon)
+        self.dct_recon = QAction("DCT integration", self, checkable=True)
+        self.dct_recon.triggered.connect(self.padding_recon)
+        self.weighted_recon = QAction("Weighted integration", self, checkable=True)
+        self.weighted_recon.triggered.connect(self.padding_recon)
+        self.phase_corr_opt = QAction("Phase-correlation start", self, checkable=True)
+        self.neighbor_start_opt = QAction("Neighbor start", self, checkable=True)
+        self.checkpoint_opt = QAction("Checkpoint and resume", self, checkable=True)
 
         file_menu = self.menu.addMenu("File")
         file_menu.addAction(self.save_result_tiff)
@@ -838,6 +868,11 @@ class DPCWindow(QMainWindow):
         option_menu.addAction(self.hanging_opt)
         option_menu.addAction(self.pyramid_scan)
         option_menu.addAction(self.pad_recon)
+        option_menu.addAction(self.dct_recon)
+        option_menu.addAction(self.weighted_recon)
+        option_menu.addAction(self.phase_corr_opt)
+        option_menu.addAction(self.neighbor_start_opt)
+        option_menu.addAction(self.checkpoint_opt)
 
         if hxntools is not None:
             self.monitor_scans = QAction("Monitor acquired scans", self, checkable=True)
@@ -953,13 +988,20 @@ class DPCWindow(QMainWindow):
             "reverse_y": [getter("re_y"), checked_setter(self.reverse_y, -1)],
             "random": [getter("random"), checked_setter(self.random_processing_opt, 1)],
             "pyramid": [getter("pyramid"), checked_setter(self.pyramid_scan, 1)],
-            "pad": [getter("pad"), checked_setter(self.pad_recon, True)],
+            "pad": [getter("pad"), self.set_pad],
             "hang": [getter("hang"), checked_setter(self.hanging_opt, 1)],
+            "phase_corr_init": [getter("phase_corr_init"), checked_setter(self.phase_corr_opt, 1)],
+            "neighbor_start": [getter("neighbor_start"), checked_setter(self.neighbor_start_opt, 1)],
+            "checkpoint": [getter("checkpoint"), checked_setter(self.checkpoint_opt, 1)],
             "ref_image": [getter("ref_image"), self.ref_image_path_QLineEdit.setText],
             "first_image": [getter("first_image"), typed_setter(self.first_widget.setValue, int)],
             "processes": [getter("processes"), typed_setter(self.processes_widget.setValue, int)],
+            "chunksize": [getter("chunksize"), typed_setter(self.chunksize_widget.setValue, int)],
+            "max_inflight": [getter("max_inflight"), typed_setter(self.max_inflight_widget.setValue, int)],
+            "executor": [getter("executor"), setter("executor")],
             "bad_pixels": [getter("bad_pixels"), self.set_bad_pixels],
             "solver": [getter("solver"), setter("solver")],
+            "processing_mode": [getter("processing_mode"), setter("processing_mode")],
             "last_path": [getter("last_path"), setter("last_path")],
             "scan_number": [getter("scan_number"), setter("scan_number")],
             "use_mds": [getter("use_mds"), setter("use_mds")],
@@ -1459,7 +1501,7 @@ class DPCWindow(QMainWindow):
             strap_gy = gy[self.strap_start.value() : self.strap_end.value(), :]
             line_gy = np.mean(strap_gy, axis=0)
             self.gy_r = gy - line_gy
-            self.phi_r = dpc.recon(self.gx_r, self.gy_r, self.dx_widget.value(), self.dy_widget.value())
+            self.phi_r = self.reconstruct_phase(self.gx_r, self.gy_r)
             self.update_display(a, self.gx_r, self.gy_r, self.phi_r, rx, ry)
 
         if self.direction == -1:
@@ -1474,7 +1516,7 @@ class DPCWindow(QMainWindow):
             self.gy_r = np.transpose(gy)
             self.gy_r = self.gy_r - line_gy
             self.gy_r = np.transpose(self.gy_r)
-            self.phi_r = dpc.recon(self.gx_r, self.gy_r, self.dx_widget.value(), self.dy_widget.value())
+            self.phi_r = self.reconstruct_phase(self.gx_r, self.gy_r)
             self.update_display(a, self.gx_r, self.gy_r, self.phi_r, rx, ry)
 
     def confirm(self, pressed):
@@ -1721,13 +1763,23 @@ class DPCWindow(QMainWindow):
             param_file.write("mosaic_column_number_x = {0}\n".format(settings["mosaic_x"]))
             param_file.write("mosaic_column_number_y = {0}\n".format(settings["mosaic_y"]))
             param_file.write("solver = {0}\n".format(settings["solver"]))
+            param_file.write("processing_mode = {0}\n".format(settings["processing_mode"]))
             param_file.write("random = {0}\n".format(settings["random"]))
             param_file.write("pyramid = {0}\n".format(settings["pyramid"]))
             param_file.write("hang = {0}\n".format(settings["hang"]))
+            param_file.write("phase_corr_init = {0}\n".format(settings["phase_corr_init"]))
+            param_file.write("neighbor_start = {0}\n".format(settings["neighbor_start"]))
+            param_file.write("checkpoint = {0}\n".format(settings["checkpoint"]))
+            param_file.write("chunksize = {0}\n".format(settings["chunksize"]))
+            param_file.write("max_inflight = {0}\n".format(settings["max_inflight"]))
+            param_file.write("executor = {0}\n".format(settings["executor"]))
             param_file.write("swap = {0}\n".format(settings["swap"]))
             param_file.write("reverse_x = {0}\n".format(settings["reverse_x"]))
             param_file.write("reverse_y = {0}\n".format(settings["reverse_y"]))
-            param_file.write("pad = {0}\n".format(1 if settings["pad"] else 0))
+            if settings["pad"] in ("DCT", "Weighted"):
+                param_file.write("pad = {0}\n".format(settings["pad"]))
+            else:
+                param_file.write("pad = {0}\n".format(1 if settings["pad"] else 0))
             param_file.write("bad_pixels = {0}\n".format(settings["bad_pixels"]))
 
             param_file.close()
@@ -1804,6 +1856,10 @@ class DPCWindow(QMainWindow):
                     slist = line.strip().split("=")
                     settings.setValue("solver", "{0}".format(slist[1].strip()))
 
+                elif "processing_mode" in line.lower():
+                    slist = line.strip().split("=")
+                    settings.setValue("processing_mode", "{0}".format(slist[1].strip()))
+
                 elif "random" in line.lower():
                     slist = line.strip().split("=")
                     settings.setValue("random", int(slist[1]))
@@ -1816,6 +1872,30 @@ class DPCWindow(QMainWindow):
                     slist = line.strip().split("=")
                     settings.setValue("hang", int(slist[1]))
 
+                elif "phase_corr_init" in line.lower():
+                    slist = line.strip().split("=")
+                    settings.setValue("phase_corr_init", int(slist[1]))
+
+                elif "neighbor_start" in line.lower():
+                    slist = line.strip().split("=")
+                    settings.setValue("neighbor_start", int(slist[1]))
+
+                elif "checkpoint" in line.lower():
+                    slist = line.strip().split("=")
+                    settings.setValue("checkpoint", int(slist[1]))
+
+                elif "chunksize" in line.lower():
+                    slist = line.strip().split("=")
+                    settings.setValue("chunksize", int(slist[1]))
+
+                elif "max_inflight" in line.lower():
+                    slist = line.strip().split("=")
+                    settings.setValue("max_inflight", int(slist[1]))
+
+                elif "executor" in line.lower():
+                    slist = line.strip().split("=")
+                    settings.setValue("executor", "{0}".format(slist[1].strip()))
+
                 elif "swap" in line.lower():
                     slist = line.strip().split("=")
                     settings.setValue("swap", int(slist[1]))
@@ -1830,7 +1910,7 @@ class DPCWindow(QMainWindow):
 
                 elif "pad" in line.lower():
                     slist = line.strip().split("=")
-                    settings.setValue("pad", int(slist[1]))
+                    settings.setValue("pad", slist[1].strip())
 
                 elif "bad_pixels" in line.lower():
                     slist = line.strip().split("=")
@@ -1894,31 +1974,42 @@ class DPCWindow(QMainWindow):
     def swap_x_y(self):
         global a, gx, gy, phi, rx, ry
         gx, gy = gy, gx
-        phi = dpc.recon(gx, gy, self.dx_widget.value(), self.dy_widget.value())
+        # the residuals follow their gradients
+        rx, ry = ry, rx
+        phi = self.reconstruct_phase(gx, gy)
         self.update_display(a, gx, gy, phi, rx, ry)
 
     def reverse_gx(self):
         global a, gx, gy, phi, rx, ry
         gx = -gx
-        phi = dpc.recon(gx, gy, self.dx_widget.value(), self.dy_widget.value())
+        phi = self.reconstruct_phase(gx, gy)
         self.update_display(a, gx, gy, phi, rx, ry)
 
     def reverse_gy(self):
         global a, gx, gy, phi, rx, ry
         gy = -gy
-        phi = dpc.recon(gx, gy, self.dx_widget.value(), self.dy_widget.value())
+        phi = self.reconstruct_phase(gx, gy)
         self.update_display(a, gx, gy, phi, rx, ry)
 
     def padding_recon(self):
         global a, gx, gy, phi, rx, ry
-        if self.pad_recon.isChecked():
-            phi = dpc.recon(gx, gy, self.dx_widget.value(), self.dy_widget.value(), 3)
-            print("Padding mode enabled!")
-        else:
-            phi = dpc.recon(gx, gy, self.dx_widget.value(), self.dy_widget.value())
-            print("Padding mode disabled!")
+        # at most one of the reconstruction options is checked
+        options = (self.pad_recon, self.dct_recon, self.weighted_recon)
+        if self.sender() in options and self.sender().isChecked():
+            for option in options:
+                option.setChecked(option is self.sender())
+        phi = self.reconstruct_phase(gx, gy)
         self.update_display(a, gx, gy, phi, rx, ry)
 
+    def reconstruct_phase(self, gx, gy):
+        """
+        Phase of the gradient maps, with the reconstruction selected by the
+        padding, DCT and weighted options
+        """
+        # the residuals of the fits of gx and gy
+        res_x, res_y = (ry, rx) if self.swap == 1 else (rx, ry)
+        return dpc.recon_maps(gx, gy, self.dx_widget.value(), self.dy_widget.value(), self.pad, res_x, res_y, a)
+
     def select_ref_img(self):
         """
         Select the reference image and record its location and name
@@ -1946,7 +2037,11 @@ class DPCWindow(QMainWindow):
                     ref_path = str(self.file_widget.text()) % self.first_widget.value()
 
             try:
-                self.roi_img = self.load_image(ref_path)
+                if self.load_image == load_image_hdf5:
+                    # the reference is the first frame of the map
+                    self.roi_img = self.load_image(ref_path, max(self.first_widget.value() - 1, 0))
+                else:
+                    self.roi_img = self.load_image(ref_path)
 
                 self.roi_img_masked = self.roi_img.copy()
 
@@ -2183,6 +2278,22 @@ class DPCWindow(QMainWindow):
     def processes(self):
         return int(self.processes_widget.text())
 
+    @property
+    def chunksize(self):
+        return int(self.chunksize_widget.value())
+
+    @property
+    def max_inflight(self):
+        return int(self.max_inflight_widget.value())
+
+    @property
+    def executor(self):
+        return dpc.EXECUTORS[self.executor_widget.currentIndex()]
+
+    @executor.setter
+    def executor(self, executor):
+        self.executor_widget.setCurrentIndex(dpc.EXECUTORS.index(executor))
+
     @property
     def file_format(self):
         return str(self.file_widget.text())
@@ -2240,11 +2351,21 @@ class DPCWindow(QMainWindow):
 
     @property
     def pad(self):
-        if self.pad_recon.isChecked():
+        if self.weighted_recon.isChecked():
+            return "Weighted"
+        elif self.dct_recon.isChecked():
+            return "DCT"
+        elif self.pad_recon.isChecked():
             return True
         else:
             return False
 
+    def set_pad(self, pad):
+        mode = dpc.recon_mode(pad)
+        self.pad_recon.setChecked(mode == "Fourier-padded")
+        self.dct_recon.setChecked(mode == "DCT")
+        self.weighted_recon.setChecked(mode == "Weighted")
+
     @property
     def pyramid(self):
         if self.pyramid_scan.isChecked():
@@ -2280,6 +2401,42 @@ class DPCWindow(QMainWindow):
         else:
             return -1
 
+    @property
+    def phase_corr_init(self):
+        if self.phase_corr_opt.isChecked():
+            return 1
+        else:
+            return -1
+
+    @property
+    def neighbor_start(self):
+        if self.neighbor_start_opt.isChecked():
+            return 1
+        else:
+            return -1
+
+    @property
+    def checkpoint(self):
+        if self.checkpoint_opt.isChecked():
+            return 1
+        else:
+            return -1
+
+    @property
+    def checkpoint_path(self):
+        """
+        Checkpoint file of the scan, in the save directory, or in the
+        directory of the data when no save directory is set
+        """
+        if self.use_mds:
+            name = "S{0}".format(self.scan_number)
+        else:
+            # the file name without its frame number placeholder, e.g. "%05d"
+            name = re.sub(r"%[-+ #0]*\d*(\.\d+)?[diouxXs]", "", os.path.basename(self.file_format))
+            name = os.path.splitext(name)[0].strip("_-. ") or "scan"
+        directory = self.save_path or os.path.dirname(self.file_format)
+        return os.path.join(directory, name + "_checkpoint.npz")
+
     @property
     def first_image(self):
         return self.first_widget.value()
@@ -2427,6 +2584,14 @@ class DPCWindow(QMainWindow):
     def solver(self, solver):
         self.solver_widget.setCurrentIndex(SOLVERS.index(solver))
 
+    @property
+    def processing_mode(self):
+        return dpc.PROCESSING_MODES[self.processing_mode_widget.currentIndex()]
+
+    @processing_mode.setter
+    def processing_mode(self, mode):
+        self.processing_mode_widget.setCurrentIndex(dpc.PROCESSING_MODES.index(mode))
+
     def set_bad_pixels(self, pixels):
         w = self.bad_pixels_widget
         w.clear()
@@ -2444,7 +2609,7 @@ class DPCWindow(QMainWindow):
     def dpc_settings(self):
         ret = {}
         for key, (getter, setter) in self._settings.items():
-            if key not in ("last_path", "scan_number", "filestore_key", "processes"):
+            if key not in ("last_path", "scan_number", "filestore_key"):
                 ret[key] = getter()
         return ret
 
@@ -2467,7 +2632,12 @@ class DPCWindow(QMainWindow):
         self.hanging_opt.setEnabled(False)
         self.random_processing_opt.setEnabled(False)
         self.pyramid_scan.setEnabled(False)
+        self.phase_corr_opt.setEnabled(False)
+        self.neighbor_start_opt.setEnabled(False)
+        self.checkpoint_opt.setEnabled(False)
         self.pad_recon.setEnabled(False)
+        self.dct_recon.setEnabled(False)
+        self.weighted_recon.setEnabled(False)
         self.save_result_tiff.setEnabled(False)
         self.save_result_txt.setEnabled(False)
         self.canvas_widget.show()
@@ -2480,7 +2650,7 @@ class DPCWindow(QMainWindow):
             self._thread = None
 
         if self._thread is None:
-            if self.processes == 0:
+            if self.processes == 0 or self.executor != "processes":
                 pool = None
             else:
                 pool = mp.Pool(processes=self.processes)
@@ -2492,6 +2662,22 @@ class DPCWindow(QMainWindow):
             if self.use_mds:
                 thread.dpc_settings["scan"] = self.scan
 
+            # stop() terminates the thread: only the periodic checkpoints of
+            # a cancelled run are kept
+            thread.dpc_settings["checkpoint"] = None
+            if self.checkpoint == 1:
+                checkpoint_path = self.checkpoint_path
+                directory = os.path.dirname(checkpoint_path) or "."
+                if os.path.isdir(directory) and os.access(directory, os.W_OK):
+                    thread.dpc_settings["checkpoint"] = checkpoint_path
+                    thread.dpc_settings["checkpoint_interval"] = 10.0
+                else:
+                    msg = (
+                        "Cannot write checkpoints to {0}, the fit runs without them. "
+                        "Set a writable save path to be able to resume it.".format(directory)
+                    )
+                    QMessageBox.information(self, "Checkpoint", msg, QMessageBox.Ok)
+
             if self.load_image == load_image_hdf5:
                 thread.dpc_settings["use_hdf5"] = True
             else:
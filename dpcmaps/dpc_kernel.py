@@ -16,16 +16,38 @@ https://docs.google.com/file/d/0B3v6W1bQwN_AdjZwWmE3WTNqVnc/edit?usp=sharing
 """
 from __future__ import print_function, division
 import os
+import functools
+import hashlib
+import inspect
+import itertools
+import signal
+import threading
+from collections import OrderedDict
+from concurrent.futures import (
+    Executor,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    FIRST_COMPLETED,
+    wait,
+)
 import numpy as np
 import matplotlib.pyplot as plt
 import PIL
 
-from scipy.optimize import minimize
+from scipy.fft import dctn, idctn
+from scipy.optimize import minimize, minimize_scalar
 import time
 from six import StringIO
 import dpcmaps.load_timepix as load_timepix
 import h5py
 
+try:
+    from multiprocessing import resource_tracker, shared_memory
+except ImportError:
+    # Python < 3.8
+    shared_memory = None
+
 from dpcmaps.db_config.db_config import db
 
 # try:
@@ -56,6 +78,389 @@ def rss(v, xdata, ydata, beta):
     return np.sum(np.abs(ydata - fitted_curve) ** 2)
 
 
+def fit_lm(xdata, ydata, beta, start_point=[1, 0], max_iters=1000, tol=1e-6):
+    """
+    Levenberg-Marquardt fit of ``ydata = xdata * a * exp(s * beta)``
+
+    The Jacobian of the residual with respect to ``(a, s)`` is known
+    analytically and its normal matrix is diagonal, so every iteration costs
+    a single complex exponential. The fit typically converges in a handful
+    of iterations, compared with hundreds of ``rss`` evaluations for the
+    simplex search.
+
+    Parameters
+    ----------
+    xdata : 1-D complex numpy array
+        reference spectrum
+    ydata : 1-D complex numpy array
+        spectrum of the frame
+    beta : 1-D complex numpy array
+        ``1j * k`` frequency array, see ``get_beta``
+    start_point : sequence
+        initial ``(a, s)``
+    max_iters : int
+        maximum number of iterations
+    tol : float
+        convergence tolerance on the parameter steps
+
+    Returns
+    ----------
+    v : 1-D numpy array
+        fitted ``(a, s)``
+    fun : float
+        residual sum of squares at ``v``
+    """
+    k = beta.imag
+    x2 = np.abs(xdata) ** 2
+    # Diagonal of J^T J: the (a, s) cross term vanishes identically
+    h_aa = np.sum(x2)
+    h_ss = np.sum(k**2 * x2)
+
+    a, s = float(start_point[0]), float(start_point[1])
+    m = xdata * np.exp(s * beta)
+    r = ydata - a * m
+    fun = np.sum(np.abs(r) ** 2)
+
+    if h_aa == 0:
+        return np.array([a, s]), fun
+
+    lam = 1e-3
+    for _ in range(max_iters):
+        cr = np.conj(m) * r
+        g_a = -np.sum(cr).real
+        g_s = -a * np.sum(k * cr).imag
+
+        while True:
+            da = -g_a / (h_aa * (1 + lam))
+            hs = a * a * h_ss * (1 + lam)
+            ds = -g_s / hs if hs > 0 else 0.0
+
+            m_new = xdata * np.exp((s + ds) * beta)
+            r_new = ydata - (a + da) * m_new
+            fun_new = np.sum(np.abs(r_new) ** 2)
+            if fun_new <= fun:
+                lam = max(lam / 10, 1e-12)
+                break
+
+            lam *= 10
+            if lam > 1e12:
+                return np.array([a, s]), fun
+
+        a += da
+        s += ds
+        m, r, fun = m_new, r_new, fun_new
+
+        if abs(ds) < tol and abs(da) < tol * max(1.0, abs(a)):
+            break
+
+    # The model is 2*pi-periodic in the shift
+    s = (s + np.pi) % (2 * np.pi) - np.pi
+    return np.array([a, s]), fun
+
+
+def cross_correlation_lattice(cross):
+    """
+    Evaluate ``Re(sum(cross * exp(-s * beta)))`` on the lattice of integer
+    pixel shifts ``s = 2 * pi * j / L`` with a single FFT
+
+    Parameters
+    ----------
+    cross : complex numpy array
+        cross-spectrum ``conj(xdata) * ydata``, one spectrum per row
+
+    Returns
+    ----------
+    s : 1-D numpy array
+        lattice of shifts in ``[-pi, pi)``
+    values : numpy array
+        correlation at each shift, same shape as ``cross``
+    """
+    length = cross.shape[-1]
+    j = np.fft.fftfreq(length) * length
+    values = (np.exp(2j * np.pi * j * np.floor(length / 2.0) / length) * np.fft.fft(cross, axis=-1)).real
+    return 2 * np.pi * j / length, values
+
+
+def fit_varpro(xdata, ydata, beta, start_point=[1, 0], max_iters=1000, tol=1e-6):
+    """
+    Variable-projection fit of ``ydata = xdata * a * exp(s * beta)``
+
+    For a given shift ``s`` the residual sum of squares is quadratic in ``a``
+    and is minimized by ``a = P(s) / sum(|xdata|**2)`` with
+    ``P(s) = Re(sum(conj(xdata) * ydata * exp(-s * beta)))``. The fit is
+    therefore reduced to maximizing ``P`` over the shift alone: the global
+    peak is located on the integer pixel lattice with one FFT of the
+    cross-spectrum and then refined with a bounded Brent search.
+
+    ``start_point`` is accepted for compatibility with the other solvers;
+    the search over the shift is global and does not depend on it.
+
+    Returns
+    ----------
+    v : 1-D numpy array
+        fitted ``(a, s)``
+    fun : float
+        residual sum of squares at ``v``
+    """
+    x2 = np.sum(np.abs(xdata) ** 2)
+    y2 = np.sum(np.abs(ydata) ** 2)
+    if x2 == 0:
+        return np.array([0.0, 0.0]), y2
+
+    cross = np.conj(xdata) * ydata
+    # exp(-s * beta) == conj(exp(s * beta)), with beta purely imaginary
+    nbeta = -beta
+
+    def neg_projection(s):
+        return -np.dot(cross, np.exp(s * nbeta)).real
+
+    s_grid, values = cross_correlation_lattice(cross)
+    s0 = s_grid[np.argmax(values)]
+    step = s_grid[1] - s_grid[0]
+
+    res = minimize_scalar(
+        neg_projection,
+        bounds=(s0 - step, s0 + step),
+        method="bounded",
+        options=dict(xatol=tol, maxiter=max_iters),
+    )
+
+    s = res.x
+    p = -res.fun
+    return np.array([p / x2, s]), max(y2 - p * p / x2, 0.0)
+
+
+def phase_correlation(xdata, ydata, beta=None, start_point=[1, 0], max_iters=1000, upsample=8):
+    """
+    Estimate ``(a, s)`` from the peak of the cross-correlation of the
+    reference and frame projections
+
+    The correlation is evaluated on the integer pixel lattice with one FFT,
+    upsampled by ``upsample`` around the peak with a small matrix DFT and the
+    peak position is refined by parabolic interpolation. The result is used
+    as a start point for the iterative solvers or on its own for quick-look
+    processing.
+
+    Parameters
+    ----------
+    xdata : 1-D complex numpy array
+        reference spectrum, length L
+    ydata : complex numpy array
+        spectrum of the frame, length L, or a block of spectra, shape (N, L)
+    beta : 1-D complex numpy array, optional
+        ``1j * k`` frequency array, see ``get_beta``
+    upsample : int
+        upsampling factor of the correlation around the lattice peak
+
+    Returns
+    ----------
+    v : numpy array
+        estimated ``(a, s)``, shape (2,) or (N, 2)
+    fun : float or 1-D numpy array
+        residual sum of squares at ``v``
+    """
+    if beta is None:
+        beta = get_beta(xdata)
+    k = beta.imag
+
+    single = np.ndim(ydata) == 1
+    ydata = np.atleast_2d(ydata)
+    rows = np.arange(ydata.shape[0])
+
+    x2 = np.sum(np.abs(xdata) ** 2)
+    y2 = np.sum(np.abs(ydata) ** 2, axis=1)
+    v = np.zeros((len(rows), 2))
+    fun = y2
+
+    if x2 != 0:
+        cross = np.conj(xdata) * ydata
+        s_grid, values = cross_correlation_lattice(cross)
+        s = s_grid[np.argmax(values, axis=1)]
+
+        step = (s_grid[1] - s_grid[0]) / upsample
+        offsets = np.arange(-upsample, upsample + 1) * step
+        fine = ((cross * np.exp(-1j * s[:, np.newaxis] * k)) @ np.exp(-1j * np.outer(k, offsets))).real
+
+        peak = np.clip(np.argmax(fine, axis=1), 1, 2 * upsample - 1)
+        left, centre, right = fine[rows, peak - 1], fine[rows, peak], fine[rows, peak + 1]
+        curvature = left - 2 * centre + right
+        concave = curvature < 0
+        frac = np.where(concave, 0.5 * (left - right) / np.where(concave, curvature, 1.0), 0.0)
+        s += offsets[peak] + frac * step
+
+        p = np.sum(cross * np.exp(-1j * s[:, np.newaxis] * k), axis=1).real
+        v[:, 0] = p / x2
+        v[:, 1] = (s + np.pi) % (2 * np.pi) - np.pi
+        fun = np.maximum(y2 - p * p / x2, 0.0)
+
+    if single:
+        return v[0], fun[0]
+    return v, fun
+
+
+# Solvers implemented in this module. Any other solver name is passed on to
+# ``scipy.optimize.minimize`` as the ``method``.
+SOLVERS = {
+    "Levenberg-Marquardt": fit_lm,
+    "Variable-Projection": fit_varpro,
+    "Phase-Correlation": phase_correlation,
+}
+
+
+def fit_shift(xdata, ydata, start_point=[1, 0], solver="Nelder-Mead", max_iters=1000, phase_corr_init=False):
+    """
+    Fit the amplitude and shift of ``ydata`` with respect to ``xdata``
+
+    If ``phase_corr_init`` is set, the fit starts from the estimate of
+    ``phase_correlation`` instead of ``start_point``.
+
+    Returns
+    ----------
+    v : 1-D numpy array
+        fitted ``(a, s)``
+    fun : float
+        residual sum of squares at ``v``
+    """
+    beta = get_beta(xdata)
+    if phase_corr_init and solver != "Phase-Correlation":
+        start_point, _ = phase_correlation(xdata, ydata, beta)
+
+    if solver in SOLVERS:
+        return SOLVERS[solver](xdata, ydata, beta, start_point=start_point, max_iters=max_iters)
+
+    res = minimize(
+        rss,
+        start_point,
+        args=(xdata, ydata, beta),
+        method=solver,
+        tol=1e-6,
+        options=dict(maxiter=max_iters),
+    )
+    return res.x, res.fun
+
+
+def fit_newton_block(xdata, ydata, beta, start_point=[1, 0], max_iters=1000, tol=1e-6):
+    """
+    Fit a block of spectra against one reference at once
+
+    Uses the same amplitude-free objective as ``fit_varpro``. The peak of
+    every row is located on the integer pixel lattice with one batched FFT,
+    then all rows are refined together by Newton iterations on the shift.
+    Rows drop out of the iteration as they converge.
+
+    Parameters
+    ----------
+    xdata : 1-D complex numpy array
+        reference spectrum, length L
+    ydata : 2-D complex numpy array
+        spectra of N frames, shape (N, L)
+    beta : 1-D complex numpy array
+        ``1j * k`` frequency array, see ``get_beta``
+
+    Returns
+    ----------
+    v : 2-D numpy array
+        fitted ``(a, s)`` for each frame, shape (N, 2)
+    fun : 1-D numpy array
+        residual sum of squares for each frame
+    """
+    ydata = np.atleast_2d(ydata)
+    n_frames = ydata.shape[0]
+    k = beta.imag
+
+    x2 = np.sum(np.abs(xdata) ** 2)
+    y2 = np.sum(np.abs(ydata) ** 2, axis=1)
+    v = np.zeros((n_frames, 2))
+    if x2 == 0:
+        return v, y2
+
+    cross = np.conj(xdata) * ydata
+
+    s_grid, values = cross_correlation_lattice(cross)
+    s = s_grid[np.argmax(values, axis=1)]
+    step = s_grid[1] - s_grid[0]
+
+    active = np.arange(n_frames)
+    for _ in range(max_iters):
+        q = cross[active] * np.exp(-1j * s[active, np.newaxis] * k)
+        dp = np.sum(k * q, axis=1).imag
+        d2p = -np.sum(k**2 * q, axis=1).real
+
+        # Newton step towards the maximum; fall back to a gradient step
+        # where the objective is not locally concave
+        concave = d2p < 0
+        ds = np.where(concave, -dp / np.where(concave, d2p, 1.0), np.sign(dp) * step / 2)
+        ds = np.clip(ds, -step, step)
+        s[active] += ds
+
+        active = active[np.abs(ds) >= tol]
+        if active.size == 0:
+            break
+
+    q = cross * np.exp(-1j * s[:, np.newaxis] * k)
+    p = np.sum(q, axis=1).real
+
+    v[:, 0] = p / x2
+    v[:, 1] = (s + np.pi) % (2 * np.pi) - np.pi
+    return v, np.maximum(y2 - p * p / x2, 0.0)
+
+
+# Solvers that fit a whole (N, L) block of spectra in one call
+BATCH_SOLVERS = {
+    "Batch-Newton": fit_newton_block,
+    "Phase-Correlation": phase_correlation,
+}
+
+
+def fit_shift_block(
+    xdata,
+    ydata,
+    start_point=[1, 0],
+    solver="Batch-Newton",
+    max_iters=1000,
+    phase_corr_init=False,
+    neighbor_start=False,
+    residual_jump=4.0,
+):
+    """
+    Fit the amplitude and shift of every row of ``ydata`` with respect to ``xdata``
+
+    Solvers which are not in ``BATCH_SOLVERS`` are applied row by row with
+    ``fit_shift``. The batch solvers locate the correlation peak themselves
+    and ignore ``phase_corr_init`` and ``neighbor_start``.
+
+    With ``neighbor_start`` the rows are fitted in order and every fit starts
+    from the solution of the previous row, i.e. the previous frame in
+    acquisition order. If the residual of a fit grows by more than
+    ``residual_jump`` compared with the previous frame, the frame is fitted
+    again from a cold start and the better of the two fits is kept.
+
+    Returns
+    ----------
+    v : 2-D numpy array
+        fitted ``(a, s)`` for each row, shape (N, 2)
+    fun : 1-D numpy array
+        residual sum of squares for each row
+    """
+    if solver in BATCH_SOLVERS:
+        return BATCH_SOLVERS[solver](xdata, ydata, get_beta(xdata), start_point=start_point, max_iters=max_iters)
+
+    v = np.zeros((len(ydata), 2))
+    fun = np.zeros(len(ydata))
+    for n, row in enumerate(ydata):
+        if not neighbor_start or n == 0:
+            v[n], fun[n] = fit_shift(xdata, row, start_point, solver, max_iters, phase_corr_init)
+            continue
+
+        v[n], fun[n] = fit_shift(xdata, row, v[n - 1], solver, max_iters)
+        if fun[n] > residual_jump * fun[n - 1] + 1e-12 * np.sum(np.abs(row) ** 2):
+            v_cold, fun_cold = fit_shift(xdata, row, start_point, solver, max_iters, phase_corr_init)
+            if fun_cold < fun[n]:
+                v[n], fun[n] = v_cold, fun_cold
+
+    return v, fun
+
+
 def pil_load(fn):
     im = PIL.Image.open(fn)
 
@@ -87,31 +492,391 @@ def load_image_filestore(datum_id):
         raise
 
 
+# HDF5 files opened by this process: path -> (pid, mtime, h5py.File), the
+# least recently used first. The lock is held while a cached file is looked
+# up and read, so that no thread closes a file another one is reading from.
+hdf5_files = OrderedDict()
+hdf5_lock = threading.RLock()
+
+# Most HDF5 files kept open by a process; the batch raises it to the number
+# of scans fitted at once, so that concurrent scans do not close each
+# other's files
+HDF5_MAX_OPEN_FILES = 2
+
+
+def set_hdf5_max_open_files(count):
+    """Set HDF5_MAX_OPEN_FILES, closing the least recently used files beyond it"""
+    global HDF5_MAX_OPEN_FILES
+    HDF5_MAX_OPEN_FILES = max(int(count), 1)
+    with hdf5_lock:
+        while len(hdf5_files) > HDF5_MAX_OPEN_FILES:
+            close_hdf5_file(next(iter(hdf5_files)))
+
+
+def close_hdf5_file(file_path):
+    """Drop a file from the cache of open_hdf5_cached, closing it if it was opened by this process"""
+    owner, _, f = hdf5_files.pop(file_path)
+    if owner == os.getpid():
+        f.close()
+
+
+def reset_hdf5_lock():
+    # A forked worker may inherit the lock held by another thread of its parent
+    global hdf5_lock
+    hdf5_lock = threading.RLock()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=reset_hdf5_lock)
+
+
+def open_hdf5_cached(file_path):
+    """
+    Detector dataset of an HDF5 file, opened once per process
+
+    The file stays open for the following calls on the same file. At most
+    ``HDF5_MAX_OPEN_FILES`` files are kept open, the least recently used
+    one being closed when another file is opened. The file is reopened when
+    it has been modified on disk, and handles inherited from the parent of a
+    forked worker are never reused. The caller holds ``hdf5_lock`` while it
+    reads from the dataset.
+    """
+    file_path = str(file_path)
+    pid = os.getpid()
+    mtime = os.stat(file_path).st_mtime
+
+    for path in [path for path, (owner, _, _) in hdf5_files.items() if owner != pid]:
+        close_hdf5_file(path)
+
+    if file_path in hdf5_files:
+        if hdf5_files[file_path][1] == mtime:
+            hdf5_files.move_to_end(file_path)
+            return hdf5_files[file_path][2]["entry"]["instrument"]["detector"]["data"]
+        close_hdf5_file(file_path)
+
+    while len(hdf5_files) >= HDF5_MAX_OPEN_FILES:
+        close_hdf5_file(next(iter(hdf5_files)))
+
+    f = h5py.File(file_path, "r")
+    hdf5_files[file_path] = (pid, mtime, f)
+    return f["entry"]["instrument"]["detector"]["data"]
+
+
+def load_frames_hdf5(file_path, start, stop=None):
+    """
+    Read one frame, or the frames ``start:stop``, from the detector dataset
+    without loading the rest of the stack; the file is kept open
+    (``open_hdf5_cached``)
+    """
+    with hdf5_lock:
+        dsdata = open_hdf5_cached(file_path)
+        if stop is None:
+            return dsdata[start, :, :]
+        return dsdata[start:stop, :, :]
+
+
 def load_data_hdf5(file_path):
     """
-    Read images using the h5py lib
+    Read the whole detector stack
+
+    main streams the stack in blocks instead (``project_hdf5``); use
+    ``load_frames_hdf5`` to read some of the frames.
     """
-    f = h5py.File(str(file_path), "r")
-    entry = f["entry"]
-    instrument = entry["instrument"]
-    detector = instrument["detector"]
-    dsdata = detector["data"]
-    data = dsdata[...]
-    f.close()
+    with h5py.File(str(file_path), "r") as f:
+        return f["entry"]["instrument"]["detector"]["data"][...]
 
-    return np.array(data)
 
+def detector_shape_hdf5(file_path):
+    """Shape and dtype of the detector dataset, without reading it"""
+    with hdf5_lock:
+        dsdata = open_hdf5_cached(file_path)
+        return dsdata.shape, dsdata.dtype
 
-def load_file(load_image, fn, hang, roi=None, bad_pixels=[], zip_file=None):
+
+# Memory for the detector frames read at once from an HDF5 file, in MB
+HDF5_BUDGET_MB = 1024
+
+
+def hdf5_frame_blocks(dsdata, start, stop, budget_mb=HDF5_BUDGET_MB):
     """
-    Load an image file
+    Split the frames ``start:stop`` of a dataset into blocks of at most
+    ``budget_mb`` MB
+
+    The blocks are aligned to the chunks of the dataset, so that no chunk
+    is read, and decompressed, twice, unless a single chunk exceeds the
+    budget. Blocks hold at least one frame.
+
+    Returns
+    ----------
+    blocks : list of (int, int)
+        ``(first, last + 1)`` frame of each block
+    """
+    frame_bytes = int(np.prod(dsdata.shape[1:])) * dsdata.dtype.itemsize
+    block_frames = max(int(budget_mb * 2**20) // max(frame_bytes, 1), 1)
+
+    chunk_frames = dsdata.chunks[0] if dsdata.chunks else 1
+    if block_frames >= chunk_frames:
+        block_frames -= block_frames % chunk_frames
+
+    edges = list(range((start // block_frames + 1) * block_frames, stop, block_frames))
+    edges = [start] + edges + [stop]
+    return list(zip(edges[:-1], edges[1:]))
+
+
+def iter_frames_hdf5(file_path, start, stop, budget_mb=HDF5_BUDGET_MB):
+    """
+    Iterate over the frames ``start:stop`` of the detector dataset in
+    chunk-aligned blocks of at most ``budget_mb`` MB
+    """
+    with h5py.File(str(file_path), "r") as f:
+        dsdata = f["entry"]["instrument"]["detector"]["data"]
+        for first, last in hdf5_frame_blocks(dsdata, start, stop, budget_mb):
+            yield dsdata[first:last, :, :]
+
+
+def read_frames(dsdata, frames):
+    """
+    Read frames, given by an index or an increasing array of indices, from a
+    dataset; consecutive frames are read as one slice
+
+    Returns
+    ----------
+    stack : numpy array
+        shape (N, rows, cols)
+    """
+    frames = np.atleast_1d(frames)
+    if np.all(np.diff(frames) == 1):
+        return dsdata[frames[0] : frames[-1] + 1, :, :]
+    return dsdata[frames, :, :]
+
+
+def project_hdf5(file_path, start, stop, roi=None, bad_pixels=[], budget_mb=HDF5_BUDGET_MB):
+    """
+    Projections of the frames ``start:stop`` of the detector dataset
+
+    The frames are streamed from the file with ``iter_frames_hdf5``, so at
+    most ``budget_mb`` MB of them are in memory at any time, whatever the
+    size of the scan.
+
+    Returns
+    ----------
+    xline, yline : numpy arrays
+        as ``project_stack``, shape (stop - start, Lx) and (stop - start, Ly)
+    """
+    xline = yline = None
+    n = 0
+    for block in iter_frames_hdf5(file_path, start, stop, budget_mb):
+        xl, yl = project_stack(block, roi=roi, bad_pixels=bad_pixels)
+        del block
+        if xline is None:
+            xline = np.empty((stop - start, xl.shape[1]))
+            yline = np.empty((stop - start, yl.shape[1]))
+        xline[n : n + len(xl)] = xl
+        yline[n : n + len(yl)] = yl
+        n += len(xl)
+
+    return xline, yline
+
+
+def normalize_bad_pixels(bad_pixels):
+    """Bad pixels as a sorted (N, 2) array of unique (x, y)"""
+    pixels = sorted({(int(x), int(y)) for x, y in (bad_pixels if bad_pixels is not None else [])})
+    return np.array(pixels, dtype=int).reshape(-1, 2)
+
+
+def save_projections(sidecar_path, xline, yline, file_path, start, roi=None, bad_pixels=[]):
+    """
+    Save the projections of the frames ``start:start + len(xline)`` of an
+    HDF5 scan to a sidecar file, with their provenance: the scan file, its
+    size and modification time, the ROI and the bad pixels
+    """
+    tmp_path = sidecar_path + ".tmp"
+    with h5py.File(tmp_path, "w") as f:
+        f.create_dataset("xline", data=xline)
+        f.create_dataset("yline", data=yline)
+        f.attrs["source"] = os.path.abspath(file_path)
+        if os.path.isfile(file_path):
+            st = os.stat(file_path)
+            f.attrs["source_size"] = st.st_size
+            f.attrs["source_mtime_ns"] = st.st_mtime_ns
+        f.attrs["start"] = start
+        f.attrs["roi"] = np.array(roi if roi is not None else [], dtype=int)
+        f.attrs["bad_pixels"] = normalize_bad_pixels(bad_pixels)
+    os.replace(tmp_path, sidecar_path)
+
+
+def load_projections(sidecar_path, file_path, start, stop, roi=None, bad_pixels=[]):
+    """
+    Projections of the frames ``start:stop`` of an HDF5 scan from a sidecar
+    saved by ``save_projections``
+
+    Returns None if the sidecar is missing, does not cover the frames, was
+    projected with another ROI or other bad pixels, or if the scan file has
+    changed since. A sidecar of a scan file which no longer exists is used.
+    """
+    if not os.path.isfile(sidecar_path):
+        return None
+
+    with h5py.File(sidecar_path, "r") as f:
+        attrs = dict(f.attrs)
+        first = int(attrs["start"])
+        if first > start or stop > first + len(f["xline"]):
+            reason = "does not cover frames %d-%d" % (start, stop - 1)
+        elif not np.array_equal(attrs["roi"], np.array(roi if roi is not None else [], dtype=int)):
+            reason = "has another ROI"
+        elif not np.array_equal(attrs["bad_pixels"], normalize_bad_pixels(bad_pixels)):
+            reason = "has other bad pixels"
+        elif os.path.isfile(file_path) and (
+            os.stat(file_path).st_size != attrs.get("source_size")
+            or os.stat(file_path).st_mtime_ns != attrs.get("source_mtime_ns")
+        ):
+            reason = "is older than %s" % file_path
+        else:
+            print("Using the projections of %s" % sidecar_path)
+            return f["xline"][start - first : stop - first], f["yline"][start - first : stop - first]
+
+    print("Projection sidecar %s %s, projecting the frames again" % (sidecar_path, reason))
+    return None
+
+
+def cached_projections(sidecar_path, file_path, start, stop, roi=None, bad_pixels=[], budget_mb=HDF5_BUDGET_MB):
+    """
+    ``project_hdf5`` through a sidecar file: the projections are loaded from
+    the sidecar if it matches (see ``load_projections``), otherwise they are
+    projected from the scan file and saved to the sidecar
+    """
+    lines = load_projections(sidecar_path, file_path, start, stop, roi=roi, bad_pixels=bad_pixels)
+    if lines is None:
+        lines = project_hdf5(file_path, start, stop, roi=roi, bad_pixels=bad_pixels, budget_mb=budget_mb)
+        try:
+            save_projections(sidecar_path, lines[0], lines[1], file_path, start, roi=roi, bad_pixels=bad_pixels)
+        except Exception as ex:
+            print("Failed to save projections to %s: (%s) %s" % (sidecar_path, ex.__class__.__name__, ex))
+    return lines
+
+
+def create_shared_array(shape, dtype="d"):
+    """
+    Allocate a zeroed array in a new shared memory block
+
+    Returns
+    ----------
+    shm : SharedMemory
+        the block; the caller closes and unlinks it when done
+    array : numpy array
+        the array backed by the block
+    descriptor : tuple
+        ``(name, shape, dtype)``, passed to the workers which attach to the
+        array with ``attach_shared_arrays``
+    """
+    dtype = np.dtype(dtype)
+    nbytes = max(int(np.prod(shape)) * dtype.itemsize, 1)
+    shm = shared_memory.SharedMemory(create=True, size=nbytes)
+    array = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    array[...] = 0
+    return shm, array, (shm.name, tuple(shape), dtype.str)
+
+
+def load_data_hdf5_shared(file_path, start=0, stop=None):
+    """
+    Read the frames ``start:stop`` of the detector stack, all of them by
+    default, straight into a new shared memory block
+
+    Returns ``(shm, data, descriptor)``, as ``create_shared_array``
+    """
+    with h5py.File(str(file_path), "r") as f:
+        dsdata = f["entry"]["instrument"]["detector"]["data"]
+        frames = range(len(dsdata))[start:stop]
+        shm, data, descriptor = create_shared_array((len(frames),) + dsdata.shape[1:], dsdata.dtype)
+        try:
+            if len(frames):
+                dsdata.read_direct(data, np.s_[frames.start : frames.stop])
+        except Exception:
+            data = None
+            release_shared_arrays(shm)
+            raise
+
+    return shm, data, descriptor
+
+
+def release_shared_arrays(*shms):
+    """
+    Unlink and close shared memory blocks created by ``create_shared_array``
+
+    A block still viewed by an array, e.g. one held by the traceback of an
+    error, is unmapped when the last such array is garbage collected.
+    """
+    for shm in shms:
+        if shm is not None:
+            shm.unlink()
+            try:
+                shm.close()
+            except BufferError:
+                pass
+
+
+# Shared memory blocks attached by this (worker) process, by name
+shared_blocks = {}
+
+
+def open_shared_block(name):
+    """
+    Attach to an existing shared memory block without tracking it
+
+    The block is unlinked by the process that created it; a block tracked
+    here would be unlinked by the resource tracker of this process as soon as
+    it exits, e.g. when a pool worker is replaced.
+    """
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 has no ``track`` argument
+        pass
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda name, rtype: None
+    try:
+        return shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+
+def attach_shared_arrays(*descriptors):
+    """
+    Attach to shared arrays given by their descriptors
+
+    The blocks stay attached for the following tasks naming the same blocks;
+    blocks of a previous scan are detached when the first task of a new scan
+    comes in.
+    """
+    names = [name for name, _, _ in descriptors]
+    for name in list(shared_blocks):
+        if name not in names:
+            shared_blocks.pop(name).close()
+
+    arrays = []
+    for name, shape, dtype in descriptors:
+        try:
+            shm = shared_blocks[name]
+        except KeyError:
+            shm = shared_blocks[name] = open_shared_block(name)
+        arrays.append(np.ndarray(shape, dtype=dtype, buffer=shm.buf))
+
+    return arrays
+
+
+def read_image(load_image, fn, hang, zip_file=None):
+    """
+    Read an image file without any processing
+
+    Returns None if the image could not be retrieved from filestore.
     """
     if load_image == load_image_filestore:
         # ignore hanging settings, just hit filestore
         try:
             im = load_image(fn)
         except Exception:
-            return None, None, None
+            return None
     else:
         if hang == 1:
             while not os.path.exists(fn):
@@ -132,58 +897,440 @@ def load_file(load_image, fn, hang, roi=None, bad_pixels=[], zip_file=None):
             stream.write(f.read())
             f.close()
 
-            stream.seek(0)
-            im = plt.imread(stream, format="tif")
-        else:
-            raise Exception("File not found: %s" % fn)
+            stream.seek(0)
+            im = plt.imread(stream, format="tif")
+        else:
+            raise Exception("File not found: %s" % fn)
+
+    return im
+
+
+def load_file(load_image, fn, hang, roi=None, bad_pixels=[], zip_file=None):
+    """
+    Load an image file
+    """
+    im = read_image(load_image, fn, hang, zip_file=zip_file)
+    if im is None:
+        return None, None, None
+
+    if bad_pixels is not None:
+        for x, y in bad_pixels:
+            im[y, x] = 0
+
+    if roi is not None:
+        x1, y1, x2, y2 = roi
+        im = im[y1 : y2 + 1, x1 : x2 + 1]
+
+    xline = np.sum(im, axis=0)
+    yline = np.sum(im, axis=1)
+
+    fx = np.fft.fftshift(np.fft.ifft(xline))
+    fy = np.fft.fftshift(np.fft.ifft(yline))
+
+    return im, fx, fy
+
+
+def load_file_h5(im, roi=None, bad_pixels=[]):
+
+    if bad_pixels is not None:
+        for x, y in bad_pixels:
+            im[y, x] = 0
+
+    if roi is not None:
+        x1, y1, x2, y2 = roi
+        im = im[y1 : y2 + 1, x1 : x2 + 1]
+
+    xline = np.sum(im, axis=0)
+    yline = np.sum(im, axis=1)
+
+    fx = np.fft.fftshift(np.fft.ifft(xline))
+    fy = np.fft.fftshift(np.fft.ifft(yline))
+
+    return im, fx, fy
+
+
+def project_stack(stack, roi=None, bad_pixels=[]):
+    """
+    Project a stack of frames onto the x and y axes
+
+    The ROI is applied as a view and the bad pixels are removed from the
+    projections, so the stack itself is neither copied nor modified.
+
+    Parameters
+    ----------
+    stack : numpy array
+        one frame, shape (rows, cols), or a stack of frames, shape (N, rows, cols)
+    roi : tuple, optional
+        ``(x1, y1, x2, y2)``, inclusive
+    bad_pixels : sequence of (x, y)
+        pixels excluded from the projections
+
+    Returns
+    ----------
+    xline : numpy array
+        projections onto the x axis, shape (N, Lx)
+    yline : numpy array
+        projections onto the y axis, shape (N, Ly)
+    """
+    stack = np.asarray(stack)
+    if stack.ndim == 2:
+        stack = stack[np.newaxis]
+
+    x1, y1 = 0, 0
+    if roi is not None:
+        x1, y1, x2, y2 = roi
+        stack = stack[:, y1 : y2 + 1, x1 : x2 + 1]
+
+    xline = np.sum(stack, axis=1, dtype=np.float64)
+    yline = np.sum(stack, axis=2, dtype=np.float64)
+
+    if bad_pixels is not None and len(bad_pixels):
+        bad = {(x - x1, y - y1) for x, y in bad_pixels}
+        bad = np.array([(x, y) for x, y in bad if 0 <= x < stack.shape[2] and 0 <= y < stack.shape[1]], dtype=int)
+        if len(bad):
+            values = stack[:, bad[:, 1], bad[:, 0]]
+            for n, (x, y) in enumerate(bad):
+                xline[:, x] -= values[:, n]
+                yline[:, y] -= values[:, n]
+
+    return xline, yline
+
+
+def projection_spectra(xline, yline):
+    """
+    Centered inverse FFTs of blocks of projections, shape (N, Lx) and (N, Ly)
+
+    Returns
+    ----------
+    fx, fy : complex numpy arrays
+        spectra in the layout expected by ``fit_shift``, same shapes as the
+        projections
+    """
+    fx = np.fft.fftshift(np.fft.ifft(xline, axis=-1), axes=-1)
+    fy = np.fft.fftshift(np.fft.ifft(yline, axis=-1), axes=-1)
+    return fx, fy
+
+
+def stack_spectra(stack, roi=None, bad_pixels=[]):
+    """
+    Projection spectra of a stack of frames, shape (N, rows, cols)
+
+    Vectorized equivalent of calling ``load_file_h5`` on every frame: the
+    ROI, the bad-pixel mask, the projections and the inverse FFTs are all
+    applied to the whole stack at once.
+
+    Returns
+    ----------
+    fx : complex numpy array
+        spectra of the x projections, shape (N, Lx)
+    fy : complex numpy array
+        spectra of the y projections, shape (N, Ly)
+    """
+    return projection_spectra(*project_stack(stack, roi=roi, bad_pixels=bad_pixels))
+
+
+# Processing modes of ``main``: the Fourier-shift fit, and the fast
+# center-of-mass and quadrant estimators for previews
+PROCESSING_MODES = ["Fourier-shift", "COM", "Quadrant"]
+
+
+def dpc_preview(xline, yline, ref_xline, ref_yline, processing_mode="COM"):
+    """
+    Center-of-mass or quadrant DPC for a block of frames
+
+    Parameters
+    ----------
+    xline, yline : numpy arrays
+        projections of the frames, shape (N, Lx) and (N, Ly), see ``project_stack``
+    ref_xline, ref_yline : numpy arrays
+        projections of the reference frame
+    processing_mode : str
+        'COM': shifts of the first moments with respect to the reference,
+        returned in the same units as the shifts fitted by ``fit_shift``
+        (``2 * pi * pixels / L``).
+        'Quadrant': normalized difference of the two halves of each
+        projection, relative to the reference.
+
+    Returns
+    ----------
+    a : 1-D numpy array
+        total intensity relative to the reference
+    sx, sy : 1-D numpy arrays
+        shift estimates along x and y
+    """
+    ref_xline = np.reshape(ref_xline, (1, -1))
+    ref_yline = np.reshape(ref_yline, (1, -1))
+
+    def estimate(line):
+        length = line.shape[-1]
+        total = np.sum(line, axis=-1)
+        safe_total = np.where(total != 0, total, 1.0)
+        if processing_mode == "COM":
+            return 2 * np.pi / length * (line @ np.arange(length)) / safe_total
+        elif processing_mode == "Quadrant":
+            half = length // 2
+            return (np.sum(line[:, length - half :], axis=-1) - np.sum(line[:, :half], axis=-1)) / safe_total
+        else:
+            raise ValueError("Unknown processing mode: %s" % processing_mode)
+
+    sx = estimate(xline) - estimate(ref_xline)
+    sy = estimate(yline) - estimate(ref_yline)
+
+    ref_total = np.sum(ref_xline)
+    a = np.sum(xline, axis=-1) / (ref_total if ref_total != 0 else 1.0)
+    missing = a == 0
+    sx[missing] = 0.0
+    sy[missing] = 0.0
+    return a, sx, sy
+
+
+# Backends running the tasks of ``main``
+EXECUTORS = ["processes", "threads", "serial"]
+
+
+class SerialExecutor(Executor):
+    """Executor running each task in the calling thread, when it is submitted"""
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+        try:
+            future.set_result(fn(*args, **kwargs))
+        except Exception as ex:
+            future.set_exception(ex)
+        return future
+
+
+class PoolExecutor(Executor):
+    """Executor running the tasks on a ``multiprocessing.Pool``"""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
+
+        def set_result(result):
+            # a cancelled future only ignores the outcome of its task
+            if future.set_running_or_notify_cancel():
+                future.set_result(result)
+
+        def set_exception(ex):
+            if future.set_running_or_notify_cancel():
+                future.set_exception(ex)
+
+        self.pool.apply_async(fn, args, kwargs, callback=set_result, error_callback=set_exception)
+        return future
+
+    def shutdown(self, wait=True, **kwargs):
+        self.pool.close()
+        if wait:
+            self.pool.join()
+
+
+def init_worker(hdf5_max_open_files=HDF5_MAX_OPEN_FILES):
+    """
+    Initializer of the worker processes of the "processes" executor
+
+    Interrupts are left to the parent process, which cancels the scan; the
+    caches of the worker (``get_beta``, ``open_hdf5_cached``,
+    ``attach_shared_arrays``) are kept from one scan to the next when the
+    executor is reused. The worker keeps as many HDF5 files open as its
+    parent.
+    """
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    set_hdf5_max_open_files(hdf5_max_open_files)
+
+
+def make_executor(executor="processes", processes=None, pool=None):
+    """
+    Executor for the tasks of ``main``
+
+    Parameters
+    ----------
+    executor : str or concurrent.futures.Executor
+        one of ``EXECUTORS``, or an executor which is used as is
+    processes : int, optional
+        number of worker processes or threads; 0 runs the tasks serially
+    pool : multiprocessing.Pool, optional
+        used by the "processes" backend instead of a new process pool
+
+    Returns
+    ----------
+    executor : concurrent.futures.Executor
+    owned : bool
+        whether the executor was created here, and is to be shut down by
+        the caller
+    """
+    if isinstance(executor, Executor):
+        return executor, False
+
+    if executor not in EXECUTORS:
+        raise ValueError("Unknown executor %r, expected one of %s" % (executor, EXECUTORS))
+
+    if executor == "serial" or (processes == 0 and pool is None):
+        return SerialExecutor(), True
+    elif executor == "threads":
+        return ThreadPoolExecutor(processes), True
+    elif pool is not None:
+        return PoolExecutor(pool), True
+    return ProcessPoolExecutor(processes, initializer=init_worker, initargs=(HDF5_MAX_OPEN_FILES,)), True
+
+
+def imap_bounded(executor, fcn, tasks, kwds, max_inflight):
+    """
+    Run ``fcn(*task, **kwds)`` on the executor for each of the tasks, with
+    at most ``max_inflight`` of them submitted at any time
+
+    The tasks are consumed lazily. Yields ``(task, results)`` in completion
+    order; an exception raised by a task is raised here. When the loop is
+    left early, by an error or an interrupt, the tasks which have not
+    started yet are cancelled.
+    """
+    tasks = iter(tasks)
+    pending = {}
+
+    try:
+        while True:
+            for task in itertools.islice(tasks, max_inflight - len(pending)):
+                pending[executor.submit(fcn, *task, **kwds)] = task
+
+            if not pending:
+                return
 
-    if bad_pixels is not None:
-        for x, y in bad_pixels:
-            im[y, x] = 0
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                task = pending.pop(future)
+                yield task, future.result()
+    finally:
+        for future in pending:
+            future.cancel()
 
-    if roi is not None:
-        x1, y1, x2, y2 = roi
-        im = im[y1 : y2 + 1, x1 : x2 + 1]
 
-    xline = np.sum(im, axis=0)
-    yline = np.sum(im, axis=1)
+def fit_projections(
+    ref_fx,
+    ref_fy,
+    fx,
+    fy,
+    start_point=[1, 0],
+    solver="Batch-Newton",
+    max_iters=1000,
+    reverse_x=1,
+    reverse_y=1,
+    phase_corr_init=False,
+    neighbor_start=False,
+):
+    """
+    Fit blocks of x and y projection spectra, shape (N, Lx) and (N, Ly)
 
-    fx = np.fft.fftshift(np.fft.ifft(xline))
-    fy = np.fft.fftshift(np.fft.ifft(yline))
+    Returns
+    ----------
+    results : numpy array
+        shape (5, N): a, gx, gy, rx and ry for each of the N frames
+    """
+    vx, rx = fit_shift_block(ref_fx, fx, start_point, solver, max_iters, phase_corr_init, neighbor_start)
+    vy, ry = fit_shift_block(ref_fy, fy, start_point, solver, max_iters, phase_corr_init, neighbor_start)
+    return np.array([vx[:, 0], reverse_x * vx[:, 1], reverse_y * vy[:, 1], rx, ry])
 
-    return im, fx, fy
 
+# Where the worker of ``main`` gets the frames of a task from
+FRAME_SOURCES = ["files", "lines", "hdf5", "shared"]
 
-def load_file_h5(im, roi=None, bad_pixels=[]):
 
-    if bad_pixels is not None:
-        for x, y in bad_pixels:
-            im[y, x] = 0
+def run_dpc_frames(
+    frames,
+    i,
+    j,
+    source="files",
+    ref_fx=None,
+    ref_fy=None,
+    roi=None,
+    bad_pixels=[],
+    load_image=load_timepix.load,
+    hang=True,
+    zip_file=None,
+    file_path=None,
+    shared_stack=None,
+    shared_results=None,
+    **fit_kwargs,
+):
+    """
+    Read one frame, or a block of frames (e.g. one scan row), and fit it
 
-    if roi is not None:
-        x1, y1, x2, y2 = roi
-        im = im[y1 : y2 + 1, x1 : x2 + 1]
+    ``frames`` depends on the ``source``:
 
-    xline = np.sum(im, axis=0)
-    yline = np.sum(im, axis=1)
+    * "files": a file name, or a sequence of them, read with ``load_image``
+    * "lines": ``(xline, yline)``, the projections of one frame (1-D) or of
+      a block of frames, as returned by ``project_stack``; ROI and bad
+      pixels must already have been applied
+    * "hdf5": the index of a frame, or an increasing array of indices, read
+      from the HDF5 file ``file_path`` by the worker; the file is opened
+      once per worker process (``open_hdf5_cached``)
+    * "shared": the index of a frame, or an array of indices, in the stack
+      described by ``shared_stack``; the results are written in place to
+      ``[:, i, j]`` of the (5, rows, cols) array described by
+      ``shared_results``, and nothing is returned
 
-    fx = np.fft.fftshift(np.fft.ifft(xline))
-    fy = np.fft.fftshift(np.fft.ifft(yline))
+    The other keyword arguments are those of ``fit_projections``.
 
-    return im, fx, fy
+    Returns
+    ----------
+    a, gx, gy, rx, ry : floats (one frame) or 1-D numpy arrays (a block)
+    """
+    if source not in FRAME_SOURCES:
+        raise ValueError("Unknown frame source %r, expected one of %s" % (source, FRAME_SOURCES))
 
+    if source == "lines":
+        xline, yline = frames
+        single = np.ndim(xline) == 1
+    else:
+        single = np.ndim(frames) == 0
 
-def xj_test(filename, i, j, hang, roi=None, bad_pixels=[], **kwargs):
-    try:
-        im, fx, fy = load_file(filename, zip_file=zip_file, hang=hang, roi=roi, bad_pixels=bad_pixels)
-    except Exception:
-        # print('Failed to load file %s: %s' % (filename, ex))
-        return 0.0, 0.0, 0.0
+    if source == "files":
+        filenames = [frames] if single else frames
+        results = np.zeros((5, len(filenames)))
+        xline = np.zeros((len(filenames), len(ref_fx)))
+        yline = np.zeros((len(filenames), len(ref_fy)))
+        loaded = np.zeros(len(filenames), dtype=bool)
 
-    wx, wy = im.shape
-    gx = np.sum(im[: wx // 2, :]) - np.sum(im[wx // 2 :, :])
-    gy = np.sum(im[:, : wy // 2]) - np.sum(im[:, wy // 2 :])
-    return 0, gx, gy
+        for n, filename in enumerate(filenames):
+            try:
+                img = read_image(load_image, filename, hang, zip_file=zip_file)
+            except IOError as ie:
+                print("%s" % ie)
+                continue
+
+            if img is None:
+                print("Image {0} was not loaded.".format(filename))
+                results[:, n] = 1e-5
+                continue
+
+            xline[n], yline[n] = project_stack(img, roi=roi, bad_pixels=bad_pixels)
+            loaded[n] = True
+    else:
+        if source == "hdf5":
+            with hdf5_lock:
+                stack = read_frames(open_hdf5_cached(file_path), frames)
+            xline, yline = project_stack(stack, roi=roi, bad_pixels=bad_pixels)
+            del stack
+        elif source == "shared":
+            stack, shared = attach_shared_arrays(shared_stack, shared_results)
+            xline, yline = project_stack(stack[np.atleast_1d(frames)], roi=roi, bad_pixels=bad_pixels)
+            del stack
+
+        xline, yline = np.atleast_2d(xline), np.atleast_2d(yline)
+        results = np.zeros((5, len(xline)))
+        loaded = np.ones(len(xline), dtype=bool)
+
+    fx, fy = projection_spectra(xline[loaded], yline[loaded])
+    results[:, loaded] = fit_projections(ref_fx, ref_fy, fx, fy, **fit_kwargs)
+
+    if source == "shared":
+        shared[:, i, j] = np.reshape(results, shared[:, i, j].shape)
+        del shared
+        return
+    if single:
+        return tuple(r[0] for r in results)
+    return results
 
 
 def run_dpc(
@@ -207,60 +1354,38 @@ def run_dpc(
     reverse_x=1,
     reverse_y=1,
     load_image=load_timepix.load,
+    phase_corr_init=False,
+    neighbor_start=False,
 ):
     """
-    All units in micron
+    Fit one frame read from a file with ``load_image``; ``run_dpc_frames``
+    with the "files" source. The geometry arguments are not used.
 
-    pixel_size
-    focus_to_det: focus to detector distance
-    dx: scan step size x
-    dy: scan step size y
-    energy: in keV
+    Returns
+    ----------
+    a, gx, gy, rx, ry : floats
     """
-    try:
-        img, fx, fy = load_file(load_image, filename, hang=hang, zip_file=zip_file, roi=roi, bad_pixels=bad_pixels)
-    except IOError as ie:
-        print("%s" % ie)
-        return 0.0, 0.0, 0.0, 0.0, 0.0
-
-    if img is None:
-        print("Image {0} was not loaded.".format(filename))
-        return 1e-5, 1e-5, 1e-5, 1e-5, 1e-5
-
-    # vx = fmin(rss, start_point, args=(ref_fx, fx, get_beta(ref_fx)),
-    #           maxiter=max_iters, maxfun=max_iters, disp=0)
-    res = minimize(
-        rss,
-        start_point,
-        args=(ref_fx, fx, get_beta(ref_fx)),
-        method=solver,
-        tol=1e-6,
-        options=dict(maxiter=max_iters),
-    )
-
-    vx = res.x
-    rx = res.fun
-    a = vx[0]
-    gx = reverse_x * vx[1]
-
-    # vy = fmin(rss, start_point, args=(ref_fy, fy, get_beta(ref_fy)),
-    #          maxiter=max_iters, maxfun=max_iters, disp=0)
-    res = minimize(
-        rss,
-        start_point,
-        args=(ref_fy, fy, get_beta(ref_fy)),
-        method=solver,
-        tol=1e-6,
-        options=dict(maxiter=max_iters),
+    return run_dpc_frames(
+        filename,
+        i,
+        j,
+        source="files",
+        ref_fx=ref_fx,
+        ref_fy=ref_fy,
+        roi=roi,
+        bad_pixels=bad_pixels,
+        load_image=load_image,
+        hang=hang,
+        zip_file=zip_file,
+        start_point=start_point,
+        solver=solver,
+        max_iters=max_iters,
+        reverse_x=reverse_x,
+        reverse_y=reverse_y,
+        phase_corr_init=phase_corr_init,
+        neighbor_start=neighbor_start,
     )
 
-    vy = res.x
-    ry = res.fun
-    gy = reverse_y * vy[1]
-
-    # print(i, j, vx[0], vx[1], vy[1])
-    return a, gx, gy, rx, ry
-
 
 def run_dpc_h5(
     dataimg,
@@ -283,58 +1408,183 @@ def run_dpc_h5(
     reverse_x=1,
     reverse_y=1,
     load_image=None,
+    phase_corr_init=False,
+    neighbor_start=False,
 ):
     """
-    All units in micron
+    Fit one detector frame given as an array; ``run_dpc_frames`` with the
+    "lines" source. The geometry arguments are not used.
 
-    pixel_size
-    focus_to_det: focus to detector distance
-    dx: scan step size x
-    dy: scan step size y
-    energy: in keV
+    Returns
+    ----------
+    a, gx, gy, rx, ry : floats
     """
-    try:
-        img, fx, fy = load_file_h5(dataimg, roi=roi, bad_pixels=bad_pixels)
-    except IOError as ie:
-        print("%s" % ie)
-        return 0.0, 0.0, 0.0, 0.0, 0.0
-
-    if img is None:
+    if dataimg is None:
         return 1e-5, 1e-5, 1e-5, 1e-5, 1e-5
 
-    # vx = fmin(rss, start_point, args=(ref_fx, fx, get_beta(ref_fx)),
-    #           maxiter=max_iters, maxfun=max_iters, disp=0)
-    res = minimize(
-        rss,
-        start_point,
-        args=(ref_fx, fx, get_beta(ref_fx)),
-        method=solver,
-        tol=1e-6,
-        options=dict(maxiter=max_iters),
+    xline, yline = project_stack(dataimg, roi=roi, bad_pixels=bad_pixels)
+    return run_dpc_frames(
+        (xline[0], yline[0]),
+        i,
+        j,
+        source="lines",
+        ref_fx=ref_fx,
+        ref_fy=ref_fy,
+        start_point=start_point,
+        solver=solver,
+        max_iters=max_iters,
+        reverse_x=reverse_x,
+        reverse_y=reverse_y,
+        phase_corr_init=phase_corr_init,
+        neighbor_start=neighbor_start,
     )
 
-    vx = res.x
-    rx = res.fun
-    a = vx[0]
-    gx = reverse_x * vx[1]
 
-    # vy = fmin(rss, start_point, args=(ref_fy, fy, get_beta(ref_fy)),
-    #          maxiter=max_iters, maxfun=max_iters, disp=0)
-    res = minimize(
-        rss,
-        start_point,
-        args=(ref_fy, fy, get_beta(ref_fy)),
-        method=solver,
-        tol=1e-6,
-        options=dict(maxiter=max_iters),
-    )
+def settings_hash(**settings):
+    """
+    Hash of the settings a set of results was computed with
+
+    Arrays are hashed by value, and an existing data file by its size and
+    modification time, so that results are not reused for a rewritten file.
+    """
+    digest = hashlib.sha1()
+    for key in sorted(settings):
+        value = settings[key]
+        if isinstance(value, np.ndarray):
+            value = value.tolist()
+        elif isinstance(value, str) and os.path.isfile(value):
+            st = os.stat(value)
+            value = (value, st.st_size, st.st_mtime_ns)
+        digest.update(("%s=%r;" % (key, value)).encode())
+    return digest.hexdigest()
+
+
+# Arguments of main that the fitted maps depend on; the others only change
+# how the fits are run, or the reconstruction of the phase
+FIT_SETTINGS = (
+    "file_format",
+    "ref_image",
+    "zip_file",
+    "rows",
+    "cols",
+    "first_image",
+    "x1",
+    "y1",
+    "x2",
+    "y2",
+    "bad_pixels",
+    "hang",
+    "start_point",
+    "pixel_size",
+    "focus_to_det",
+    "energy",
+    "solver",
+    "phase_corr_init",
+    "neighbor_start",
+    "processing_mode",
+    "pyramid",
+    "swap",
+    "reverse_x",
+    "reverse_y",
+    "mosaic_x",
+    "mosaic_y",
+)
+
+
+def fit_settings_hash(settings, **extra):
+    """
+    settings_hash of the FIT_SETTINGS in a dict of arguments of main; the
+    missing ones take their default value, as in main
+    """
+    parameters = inspect.signature(main).parameters
+    return settings_hash(**{key: settings.get(key, parameters[key].default) for key in FIT_SETTINGS}, **extra)
+
+
+def save_checkpoint(file_path, key, done, a, gx, gy, rx, ry):
+    """
+    Save the partial maps of a scan and the mask of its fitted points
+
+    The file is written under a temporary name and then renamed, so an
+    interrupted save never leaves a truncated checkpoint behind.
+    """
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, key=key, done=done, a=a, gx=gx, gy=gy, rx=rx, ry=ry)
+    os.replace(tmp_path, file_path)
+
+
+def load_checkpoint(file_path, key, shape):
+    """
+    Load a checkpoint saved by save_checkpoint
+
+    Returns
+    -------
+    done : ndarray
+        mask of the fitted points, in acquisition order
+    maps : tuple of ndarray
+        a, gx, gy, rx, ry
+
+    or None if there is no checkpoint of the same settings and shape
+    """
+    try:
+        with np.load(file_path) as data:
+            if str(data["key"]) != key or data["done"].shape != tuple(shape):
+                print("Checkpoint %s does not match the settings, starting over" % file_path)
+                return None
+            return data["done"], tuple(data[name] for name in ("a", "gx", "gy", "rx", "ry"))
+    except FileNotFoundError:
+        return None
+    except Exception as ex:
+        print("Failed to load checkpoint %s: (%s) %s" % (file_path, ex.__class__.__name__, ex))
+        return None
+
+
+class FourierIntegrator(object):
+    """
+    Fourier integration of phase gradient maps of one shape, see ``recon``
+
+    The integration kernel, with the high-pass filter, is computed once for
+    the real-input FFTs of the (padded) maps; integrating a pair of maps then
+    costs two forward and one inverse real FFT.
+    """
+
+    def __init__(self, shape, dx=0.1, dy=0.1, pad=1, w=1.0):
+        self.shape = rows, cols = tuple(shape)
+        self.fft_shape = (pad * rows, pad * cols)
+
+        # The padded maps are placed at the origin rather than in the middle
+        # of the padding: the integration is invariant under circular shifts
+        kappax = 2 * np.pi * np.fft.rfftfreq(pad * cols, dx)[np.newaxis, :]
+        kappay = 2 * np.pi * np.fft.fftfreq(pad * rows, dy)[:, np.newaxis]
+
+        denominator = kappax**2 + w * kappay**2
+        denominator[denominator == 0] = np.inf
+
+        # use a high-pass filter to suppress amplified low-frequency signals, H.Y, 08/02/2022
+        f = 1 - 0.9 * np.exp(-np.square(kappax * dx) - np.square(kappay * dy))
+
+        self.kernel_x = f * kappax / denominator
+        self.kernel_y = f * w * kappay / denominator
+        if pad * rows % 2 == 0:
+            # the y gradient term at the Nyquist frequency has no symmetric
+            # counterpart, and cancels out of the real phase
+            self.kernel_y[pad * rows // 2] = 0
+
+    def __call__(self, gx, gy):
+        tx = np.fft.rfft2(gx, self.fft_shape)
+        ty = np.fft.rfft2(gy, self.fft_shape)
+        c = 1j * (self.kernel_x * tx + self.kernel_y * ty)
+        phi = np.fft.irfft2(c, self.fft_shape)
+        rows, cols = self.shape
+        return phi[:rows, :cols]
 
-    vy = res.x
-    ry = res.fun
-    gy = reverse_y * vy[1]
 
-    # print(i, j, vx[0], vx[1], vy[1])
-    return a, gx, gy, rx, ry
+# The kernel of a large padded map takes hundreds of MB: only those of the
+# last two sets of arguments, e.g. with and without padding, are kept
+@functools.lru_cache(maxsize=2)
+def fourier_integrator(shape, dx=0.1, dy=0.1, pad=1, w=1.0):
+    """``FourierIntegrator`` of the arguments, cached for the recent ones"""
+    return FourierIntegrator(shape, dx, dy, pad, w)
 
 
 def recon(gx, gy, dx=0.1, dy=0.1, pad=1, w=1.0):
@@ -379,44 +1629,340 @@ def recon(gx, gy, dx=0.1, dy=0.1, pad=1, w=1.0):
 
     """
 
-    rows, cols = gx.shape
+    return fourier_integrator(np.shape(gx), dx, dy, pad, w)(gx, gy)
+
+
+class DCTIntegrator(object):
+    """
+    Least-squares integration of phase gradient maps of one shape with
+    Neumann boundary conditions, see ``recon_dct``
+
+    The phase minimizing the misfit of its finite differences to the
+    gradients, averaged between neighboring scan points, solves a Poisson
+    equation which the type II discrete cosine transform diagonalizes.
+    """
+
+    def __init__(self, shape, dx=0.1, dy=0.1, w=1.0):
+        self.shape = rows, cols = tuple(shape)
+        self.dx = dx
+        self.dy = dy
+        self.w = w
+
+        # frequencies of the cosines, in radians per scan step
+        kx = np.pi * np.arange(cols)[np.newaxis, :] / cols
+        ky = np.pi * np.arange(rows)[:, np.newaxis] / rows
+
+        denominator = (2 - 2 * np.cos(kx)) / dx**2 + w * (2 - 2 * np.cos(ky)) / dy**2
+        denominator[0, 0] = np.inf
+
+        self.inverse = 1 / denominator
+
+        # the high-pass filter of FourierIntegrator
+        self.filter = 1 - 0.9 * np.exp(-np.square(kx) - np.square(ky))
+
+    def divergence(self, hx, hy):
+        """
+        Divergence of x differences (rows, cols - 1) and y differences
+        (rows - 1, cols), weighted by w: the transpose of ``differences``
+        """
+        div = np.zeros(self.shape)
+        div[:, :-1] -= hx / self.dx
+        div[:, 1:] += hx / self.dx
+        div[:-1] -= self.w * hy / self.dy
+        div[1:] += self.w * hy / self.dy
+        return div
+
+    def differences(self, phi):
+        """Finite differences of a phase map between neighboring scan points"""
+        return np.diff(phi, axis=1) / self.dx, np.diff(phi, axis=0) / self.dy
+
+    def solve(self, div):
+        """Phase of zero mean whose (negative) Laplacian is ``div``"""
+        return idctn(self.inverse * dctn(div, norm="ortho"), norm="ortho")
+
+    def finish(self, phi):
+        """High-pass filtered phase, with the sign convention of recon"""
+        return -idctn(self.filter * dctn(phi, norm="ortho"), norm="ortho")
+
+    def __call__(self, gx, gy):
+        # the gradients between neighboring scan points
+        hx = (gx[:, 1:] + gx[:, :-1]) / 2
+        hy = (gy[1:] + gy[:-1]) / 2
+        return self.finish(self.solve(self.divergence(hx, hy)))
+
+
+@functools.lru_cache(maxsize=2)
+def dct_integrator(shape, dx=0.1, dy=0.1, w=1.0):
+    """``DCTIntegrator`` of the arguments, cached for the recent ones"""
+    return DCTIntegrator(shape, dx, dy, w)
+
+
+def recon_dct(gx, gy, dx=0.1, dy=0.1, w=1.0):
+    """
+    Reconstruct the final phase image without assuming periodic maps
+
+    Alternative to ``recon`` for maps whose edges differ: the Fourier
+    integration treats them as periodic, and suppresses the artifacts of the
+    jumps at the edges only by zero-padding the maps to 9 times their area.
+    Here the phase is the least-squares solution with Neumann boundary
+    conditions, from discrete cosine transforms of the maps themselves.
+
+    Parameters and the returned phase are as for ``recon``.
+    """
+    return dct_integrator(np.shape(gx), dx, dy, w)(gx, gy)
+
+
+def gradient_weights(rx=None, ry=None, a=None, floor=1e-2):
+    """
+    Confidence weights of the x and y phase gradients of each scan point,
+    from the residuals rx, ry of their fits and/or the amplitude a
+
+    Fits with residuals up to their median get weights close to 1, and
+    outliers decreasing ones; scan points with less than the median
+    amplitude, e.g. where the beam is blocked, get proportionally lower
+    weights. No weight is below ``floor``: near-zero weights leave the
+    weighted integration so ill-conditioned that it hardly converges.
+    """
+    shape = np.shape(rx if rx is not None else a)
+    weights = [np.ones(shape), np.ones(shape)]
+    for n, r in enumerate((rx, ry)):
+        if r is not None:
+            scale = np.median(r)
+            if scale > 0:
+                weights[n] = 1 / (1 + np.square(r / scale) / 4)
+    if a is not None:
+        scale = np.median(a)
+        if scale > 0:
+            amplitude = np.clip(a / scale, 0, 1)
+            weights = [weight * amplitude for weight in weights]
+    return tuple(np.maximum(weight, floor) for weight in weights)
+
+
+def harmonic_mean(a, b):
+    """Elementwise harmonic mean of non-negative arrays, 0 where either is 0"""
+    total = a + b
+    return np.divide(2 * a * b, total, out=np.zeros(np.shape(total)), where=total > 0)
+
+
+def recon_weighted(gx, gy, dx=0.1, dy=0.1, weights_x=None, weights_y=None, w=1.0, tol=1e-3, max_iters=50):
+    """
+    Reconstruct the final phase image weighting each phase gradient by the
+    confidence in it, e.g. from ``gradient_weights``
+
+    The phase is the weighted least-squares solution of the finite
+    differences used by ``recon_dct``, which it equals for uniform weights.
+    It is found by conjugate gradients, preconditioned by the unweighted
+    solution with discrete cosine transforms.
+
+    Parameters
+    ----------
+    weights_x, weights_y : 2-D numpy arrays, optional
+        weights of gx and gy, by default uniform
+    tol : float
+        relative residual of the normal equations at which to stop; 1e-3
+        is well below the accuracy of the phase
+    max_iters : int
+        maximum number of iterations; a warning is printed when they are
+        all used
+
+    Other parameters and the returned phase are as for ``recon``.
+    """
+    integrator = dct_integrator(np.shape(gx), dx, dy, w)
+    if weights_x is None:
+        weights_x = np.ones(np.shape(gx))
+    if weights_y is None:
+        weights_y = np.ones(np.shape(gy))
+
+    # weights of the gradients between neighboring scan points, the mean of
+    # two gradients being as uncertain as the sum of their variances
+    wx = harmonic_mean(weights_x[:, 1:], weights_x[:, :-1])
+    wy = harmonic_mean(weights_y[1:], weights_y[:-1])
+
+    def normal(phi):
+        hx, hy = integrator.differences(phi)
+        return integrator.divergence(wx * hx, wy * hy)
+
+    b = integrator.divergence(wx * (gx[:, 1:] + gx[:, :-1]) / 2, wy * (gy[1:] + gy[:-1]) / 2)
+    phi = integrator.solve(b)
+    r = b - normal(phi)
+    z = integrator.solve(r)
+    p = z
+    rz = np.vdot(r, z)
+    iterations = 0
+    while iterations < max_iters and np.linalg.norm(r) > tol * np.linalg.norm(b):
+        q = normal(p)
+        alpha = rz / np.vdot(p, q)
+        phi += alpha * p
+        r -= alpha * q
+        z = integrator.solve(r)
+        rz, rz_old = np.vdot(r, z), rz
+        p = z + (rz / rz_old) * p
+        iterations += 1
+    if np.linalg.norm(r) > tol * np.linalg.norm(b):
+        print(
+            "Warning: weighted integration did not converge in %d iterations (relative residual %.2g)"
+            "" % (max_iters, np.linalg.norm(r) / np.linalg.norm(b))
+        )
+
+    return integrator.finish(phi)
+
+
+# Phase reconstructions of main: the Fourier integration of the gradient
+# maps, of the maps zero-padded to 3 times their size, the DCT integration,
+# or the DCT integration weighted by the confidence in the gradients
+RECON_MODES = ["Fourier", "Fourier-padded", "DCT", "Weighted"]
+
+
+def recon_mode(pad):
+    """
+    Phase reconstruction, in RECON_MODES, of the ``pad`` setting of main: a
+    reconstruction name, in any case, or whether to pad the Fourier
+    integration (True or 1)
+    """
+    if isinstance(pad, str):
+        for mode in RECON_MODES:
+            if pad.strip().lower() == mode.lower():
+                return mode
+        pad = pad.strip().lower() in ("1", "true")
+    return "Fourier-padded" if pad == 1 else "Fourier"
+
+
+def gradient_factors(nx, ny, pixel_size=55, focus_to_det=1.46, energy=19.5, processing_mode="Fourier-shift"):
+    """
+    Factors from the shifts of projections nx and ny pixels long to the
+    phase gradients
+    """
+    if processing_mode == "Quadrant":
+        # normalized differences, not shifts: no geometric scaling
+        return 1.0, 1.0
+
+    # Wavelength in micron
+    lambda_ = 12.4e-4 / energy
+    return (
+        nx * pixel_size / (lambda_ * focus_to_det * 1e6),
+        ny * pixel_size / (lambda_ * focus_to_det * 1e6),
+    )
+
+
+# Settings of main that only scale, flip or swap the fitted shifts, or
+# change the reconstruction of the phase; saved with the raw results
+RAW_SETTINGS = ("pixel_size", "focus_to_det", "energy", "swap", "reverse_x", "reverse_y", "dx", "dy", "pad")
+
 
-    gx_padding = np.zeros((pad * rows, pad * cols), dtype="d")
-    gy_padding = np.zeros((pad * rows, pad * cols), dtype="d")
+def scale_shifts(shift_x, shift_y, factors, swap=-1, reverse_x=1, reverse_y=1):
+    """Phase gradients gx, gy of the fitted shifts, as main computes them"""
+    gx = reverse_x * shift_x * factors[0]
+    gy = reverse_y * shift_y * factors[1]
+    if swap == 1:
+        return gy, gx
+    return gx, gy
 
-    gx_padding[(pad // 2) * rows : (pad // 2 + 1) * rows, (pad // 2) * cols : (pad // 2 + 1) * cols] = gx
-    gy_padding[(pad // 2) * rows : (pad // 2 + 1) * rows, (pad // 2) * cols : (pad // 2 + 1) * cols] = gy
 
-    tx = np.fft.fftshift(np.fft.fft2(gx_padding))
-    ty = np.fft.fftshift(np.fft.fft2(gy_padding))
+def unscale_gradients(gx, gy, factors, swap=-1, reverse_x=1, reverse_y=1):
+    """Fitted shifts of the phase gradients gx, gy; the inverse of scale_shifts"""
+    if swap == 1:
+        gx, gy = gy, gx
+    return reverse_x * gx / factors[0], reverse_y * gy / factors[1]
+
+
+def save_raw_results(file_path, a, gx, gy, rx, ry, nx, ny, processing_mode="Fourier-shift", **settings):
+    """
+    Save the raw results of main: the fitted shifts, in pixels, amplitudes
+    and residuals, the projection lengths nx, ny and the RAW_SETTINGS they
+    were scaled with
+
+    The maps are in the scan order of the results of main.
+    """
+    settings = {key: settings[key] for key in RAW_SETTINGS}
+    settings["pad"] = recon_mode(settings["pad"])
+    factors = gradient_factors(
+        nx, ny, settings["pixel_size"], settings["focus_to_det"], settings["energy"], processing_mode
+    )
+    shift_x, shift_y = unscale_gradients(
+        gx, gy, factors, settings["swap"], settings["reverse_x"], settings["reverse_y"]
+    )
 
-    c = np.zeros((pad * rows, pad * cols), dtype=complex)
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            a=a,
+            shift_x=shift_x,
+            shift_y=shift_y,
+            rx=rx,
+            ry=ry,
+            nx=nx,
+            ny=ny,
+            processing_mode=processing_mode,
+            **settings,
+        )
+    os.replace(tmp_path, file_path)
 
-    mid_col = pad * cols // 2 + 1
-    mid_row = pad * rows // 2 + 1
 
-    ax = 2 * np.pi * (np.arange(pad * cols) + 1 - mid_col) / (pad * cols * dx)
-    ay = 2 * np.pi * (np.arange(pad * rows) + 1 - mid_row) / (pad * rows * dy)
+def load_raw_results(file_path):
+    """Raw results saved by save_raw_results, as a dict"""
+    with np.load(file_path) as data:
+        return {key: value.item() if value.ndim == 0 else value for key, value in data.items()}
 
-    kappax, kappay = np.meshgrid(ax, ay)
 
-    c = -1j * (kappax * tx + w * kappay * ty)
+def rescale_results(raw, **settings):
+    """
+    Results of main regenerated from its raw results, without refitting
 
-    c = np.ma.masked_values(c, 0)
-    c /= kappax**2 + w * kappay**2
-    c = np.ma.filled(c, 0)
+    Parameters
+    ----------
+    raw : dict
+        raw results, see load_raw_results
+    settings :
+        new values of the RAW_SETTINGS, e.g. energy or swap; None or missing
+        settings keep their saved value
 
-    # use a high-pass filter to suppress amplified low-frequency signals, H.Y, 08/02/2022
-    f = 1 - 0.9 * np.exp(-np.square(kappax * dx) - np.square(kappay * dy))
-    c = f * c
+    Returns
+    ----------
+    a, gx, gy, phi, rx, ry
+    """
+    unknown = set(settings) - set(RAW_SETTINGS)
+    if unknown:
+        raise ValueError("Only %s can be changed without refitting, not %s" % (RAW_SETTINGS, sorted(unknown)))
+    new = {key: raw[key] for key in RAW_SETTINGS}
+    new.update((key, value) for key, value in settings.items() if value is not None)
+
+    factors = gradient_factors(
+        raw["nx"], raw["ny"], new["pixel_size"], new["focus_to_det"], new["energy"], raw["processing_mode"]
+    )
+    gx, gy = scale_shifts(raw["shift_x"], raw["shift_y"], factors, new["swap"], new["reverse_x"], new["reverse_y"])
+    # the residuals of the fits of gx and gy
+    res_x, res_y = (raw["ry"], raw["rx"]) if new["swap"] == 1 else (raw["rx"], raw["ry"])
+    phi = recon_maps(gx, gy, new["dx"], new["dy"], new["pad"], res_x, res_y, raw["a"])
+    return raw["a"], gx, gy, phi, raw["rx"], raw["ry"]
 
-    c = np.fft.ifftshift(c)
-    phi_padding = np.fft.ifft2(c)
-    phi_padding = -phi_padding.real
 
-    phi = phi_padding[(pad // 2) * rows : (pad // 2 + 1) * rows, (pad // 2) * cols : (pad // 2 + 1) * cols]
+def recon_maps(gx, gy, dx=0.1, dy=0.1, pad=False, rx=None, ry=None, a=None, tol=1e-3, max_iters=50):
+    """
+    Phase of the gradient maps of main, or None for a line scan
 
-    return phi
+    ``pad`` selects the reconstruction, see ``recon_mode``; the weighted one
+    weights gx and gy by the residuals rx, ry of their fits and by the
+    amplitude a, see ``gradient_weights``, and stops at the ``tol`` and
+    ``max_iters`` of ``recon_weighted``.
+    """
+    dim = len(np.squeeze(gx).shape)
+    if dim == 1:
+        return None
+    mode = recon_mode(pad)
+    if mode == "Weighted":
+        print("Weighted integration enabled!")
+        weights_x, weights_y = gradient_weights(rx, ry, a)
+        return recon_weighted(gx, gy, dx, dy, weights_x, weights_y, tol=tol, max_iters=max_iters)
+    elif mode == "DCT":
+        print("DCT integration enabled!")
+        return recon_dct(gx, gy, dx, dy)
+    elif mode == "Fourier-padded":
+        print("Padding mode enabled!")
+        return recon(gx, gy, dx, dy, 3)
+    else:
+        print("Padding mode disabled!")
+        return recon(gx, gy, dx, dy)
 
 
 def main(
@@ -454,7 +2000,25 @@ def main(
     scan=None,
     save_path=None,
     pad=False,
+    recon_tol=1e-3,
+    recon_max_iters=50,
     calculate_results=False,
+    phase_corr_init=False,
+    neighbor_start=False,
+    processing_mode="Fourier-shift",
+    use_shared_memory=False,
+    hdf5_budget_mb=HDF5_BUDGET_MB,
+    read_in_workers=False,
+    display_interval=1.0,
+    chunksize=None,
+    max_inflight=None,
+    executor="processes",
+    processes=None,
+    projections=None,
+    checkpoint=None,
+    checkpoint_interval=60.0,
+    raw_results=None,
+    projection_cache=None,
 ):
     print("DPC")
     print("---")
@@ -469,7 +2033,10 @@ def main(
     print("\tenergy: %s" % energy)
     print("\tfirst image: %s" % first_image)
     print("\treference image: %s" % ref_image)
+    print("\tprocessing mode: %s" % processing_mode)
     print("\tsolver: %s" % solver)
+    print("\tphase correlation start: %s" % phase_corr_init)
+    print("\tneighbor start: %s" % neighbor_start)
     print("\thang : %s" % hang)
     print("\tswap : %s" % swap)
     print("\treverse_x : %s" % reverse_x)
@@ -477,6 +2044,14 @@ def main(
     print("\tROI: (%s, %s)-(%s, %s)" % (x1, y1, x2, y2))
     print("\tUse mds : %s" % use_mds)
     print("\tUse hdf5 : %s" % use_hdf5)
+    print("\tUse shared memory : %s" % use_shared_memory)
+    print("\tHDF5 read budget (MB) : %s" % hdf5_budget_mb)
+    print("\tRead in workers : %s" % read_in_workers)
+    print("\tChunk size : %s" % chunksize)
+    print("\tMax tasks in flight : %s" % max_inflight)
+    print("\tExecutor : %s" % executor)
+    print("\tCheckpoint : %s" % checkpoint)
+    print("\tProjection cache : %s" % projection_cache)
     print("\tScan : %s" % scan)
 
     if display_fcn is not None:
@@ -489,148 +2064,382 @@ def main(
         if y1 is not None and y2 is not None:
             roi = (x1, y1, x2, y2)
 
-    if use_hdf5:
-        # load the data
-        datastack = load_data_hdf5(file_format)
-
-        # read the reference image hdf5: only one reference image
-        reference, ref_fx, ref_fy = load_file_h5(datastack[first_image - 1, :, :], roi=roi, bad_pixels=bad_pixels)
-
-    else:
-        # read the reference image: only one reference image
-        reference, ref_fx, ref_fy = load_file(
-            load_image, ref_image, hang, zip_file=zip_file, roi=roi, bad_pixels=bad_pixels
-        )
-
     a = np.zeros((rows, cols), dtype="d")
     gx = np.zeros((rows, cols), dtype="d")
     gy = np.zeros((rows, cols), dtype="d")
     rx = np.zeros((rows, cols), dtype="d")
     ry = np.zeros((rows, cols), dtype="d")
 
-    dpc_settings = dict(
-        start_point=start_point,
-        pixel_size=pixel_size,
-        focus_to_det=focus_to_det,
-        dx=dx,
-        dy=dy,
-        energy=energy,
-        zip_file=zip_file,
-        ref_fx=ref_fx,
-        ref_fy=ref_fy,
-        roi=roi,
-        bad_pixels=bad_pixels,
-        solver=solver,
-        load_image=load_image,
-        hang=hang,
-        reverse_x=reverse_x,
-        reverse_y=reverse_y,
-    )
-
-    if use_mds:
-        image_uids = list(scan)
-        print("Filestore has %d images" % (len(image_uids)))
+    # Mask of the fitted scan points, in acquisition order. With a checkpoint
+    # of the same settings, only the missing points are read and fitted.
+    done = np.zeros((rows, cols), dtype=bool)
+    checkpoint = checkpoint if calculate_results and processing_mode == "Fourier-shift" else None
+    if checkpoint:
+        checkpoint_key = fit_settings_hash(
+            dict(
+                file_format=file_format,
+                ref_image=ref_image,
+                zip_file=zip_file,
+                rows=rows,
+                cols=cols,
+                first_image=first_image,
+                x1=x1,
+                y1=y1,
+                x2=x2,
+                y2=y2,
+                bad_pixels=bad_pixels,
+                hang=hang,
+                start_point=start_point,
+                pixel_size=pixel_size,
+                focus_to_det=focus_to_det,
+                energy=energy,
+                solver=solver,
+                phase_corr_init=phase_corr_init,
+                neighbor_start=neighbor_start,
+                processing_mode=processing_mode,
+                pyramid=pyramid,
+                swap=swap,
+                reverse_x=reverse_x,
+                reverse_y=reverse_y,
+                mosaic_x=mosaic_x,
+                mosaic_y=mosaic_y,
+            )
+        )
+        restored = load_checkpoint(checkpoint, checkpoint_key, (rows, cols))
+        if restored is not None:
+            done, (a[:], gx[:], gy[:], rx[:], ry[:]) = restored
+            print("Resuming from %s: %d of %d points done" % (checkpoint, done.sum(), done.size))
+
+    # Frames of the map which are read: the span of the missing points
+    missing = np.flatnonzero(~done.ravel())
+    read_start, read_stop = (missing[0], missing[-1] + 1) if len(missing) else (0, 0)
+
+    executor, owned = make_executor(executor, processes, pool)
+    in_process = isinstance(executor, (SerialExecutor, ThreadPoolExecutor))
+
+    # Only the Fourier-shift fit of an HDF5 stack sends whole frames to the
+    # workers; they then read them from the file or from a block of shared
+    # memory
+    read_in_workers = read_in_workers == 1 and use_hdf5 and processing_mode == "Fourier-shift"
+    use_shared_memory = use_shared_memory == 1 and not (read_in_workers or in_process)
+    use_shared_memory = use_shared_memory and use_hdf5 and processing_mode == "Fourier-shift"
+    if use_shared_memory and shared_memory is None:
+        print("Shared memory requires Python 3.8 or newer, falling back to projections")
+        use_shared_memory = False
+    shm_stack = shm_results = None
+    completed = False
+    try:
 
-        def get_filename(i, j):
-            idx = first_image + i * cols + j
-            try:
-                return image_uids[idx]
-            except IndexError:
-                return None
+        # index in the map of the first frame of the projections, or of the
+        # shared stack, sent to the workers
+        frame_offset = 0
+
+        if use_hdf5:
+            lines_in_main = not (use_shared_memory or read_in_workers)
+            first = first_image - 1
+            # with every point restored from the checkpoint no frame is read
+            restored_all = not len(missing) and projections is None and os.path.isfile(file_format)
+            if projection_cache and projections is None and lines_in_main and not restored_all:
+                if done.any():
+                    # only the missing frames are projected, see below, and
+                    # the sidecar is not completed with them
+                    projections = load_projections(
+                        projection_cache, file_format, first, first + rows * cols, roi=roi, bad_pixels=bad_pixels
+                    )
+                else:
+                    # projections saved by an earlier run, or saved for the next ones
+                    projections = cached_projections(
+                        projection_cache,
+                        file_format,
+                        first,
+                        first + rows * cols,
+                        roi=roi,
+                        bad_pixels=bad_pixels,
+                        budget_mb=hdf5_budget_mb,
+                    )
+
+            if restored_all:
+                # the sizes of the projections, for the raw results
+                reference = ref_fx = ref_fy = None
+                ny, nx = detector_shape_hdf5(file_format)[0][1:]
+                if roi is not None:
+                    ny, nx = len(range(ny)[roi[1] : roi[3] + 1]), len(range(nx)[roi[0] : roi[2] + 1])
+            elif projections is not None and lines_in_main:
+                # the reference is frame (0, 0) of the map, the first projected
+                # frame: no detector frame needs to be read
+                reference = None
+                ref_fx, ref_fy = projection_spectra(projections[0][0], projections[1][0])
+            else:
+                if use_shared_memory:
+                    shm_stack, datastack, shared_stack = load_data_hdf5_shared(
+                        file_format, first + read_start, first + read_stop
+                    )
+                    frame_offset = read_start
+                    del datastack
+
+                # the frames are streamed from the file, not loaded at once
+                reference = load_frames_hdf5(file_format, first)
+
+                # read the reference image hdf5: only one reference image
+                reference, ref_fx, ref_fy = load_file_h5(reference, roi=roi, bad_pixels=bad_pixels)
+
+            if processing_mode == "Fourier-shift" and lines_in_main and not restored_all:
+                if projections is not None:
+                    # read ahead, e.g. by the batch pipeline, or from the sidecar
+                    xlines, ylines = projections
+                else:
+                    # Reduce the frames of the missing points to their
+                    # projections, which are all that is sent to the workers
+                    xlines, ylines = project_hdf5(
+                        file_format,
+                        first + read_start,
+                        first + read_stop,
+                        roi=roi,
+                        bad_pixels=bad_pixels,
+                        budget_mb=hdf5_budget_mb,
+                    )
+                    frame_offset = read_start
 
-    elif use_hdf5:
+        else:
+            # read the reference image: only one reference image
+            reference, ref_fx, ref_fy = load_file(
+                load_image, ref_image, hang, zip_file=zip_file, roi=roi, bad_pixels=bad_pixels
+            )
+
+        if ref_fx is not None:
+            nx, ny = len(ref_fx), len(ref_fy)
+
+        dpc_settings = dict(
+            source="files",
+            start_point=start_point,
+            zip_file=zip_file,
+            ref_fx=ref_fx,
+            ref_fy=ref_fy,
+            roi=roi,
+            bad_pixels=bad_pixels,
+            solver=solver,
+            load_image=load_image,
+            hang=hang,
+            reverse_x=reverse_x,
+            reverse_y=reverse_y,
+            phase_corr_init=(phase_corr_init == 1),
+            neighbor_start=(neighbor_start == 1),
+        )
 
-        def get_filename(i, j):
-            frame_num = first_image + i * cols + j - 1
-            return frame_num
+        if read_in_workers:
+            dpc_settings.update(source="hdf5", file_path=file_format)
+        elif use_shared_memory:
+            shm_results, shared_results, shared_results_desc = create_shared_array((5, rows, cols))
+            dpc_settings.update(source="shared", shared_stack=shared_stack, shared_results=shared_results_desc)
+        elif use_hdf5:
+            dpc_settings.update(source="lines")
 
-    else:
+        if use_mds:
+            image_uids = list(scan)
+            print("Filestore has %d images" % (len(image_uids)))
 
-        def get_filename(i, j):
-            frame_num = first_image + i * cols + j
-            return file_format % frame_num
+            def get_filename(i, j):
+                idx = first_image + i * cols + j
+                try:
+                    return image_uids[idx]
+                except IndexError:
+                    return None
 
-    # Wavelength in micron
-    lambda_ = 12.4e-4 / energy
+        elif use_hdf5:
 
-    _t0 = time.time()
+            def get_filename(i, j):
+                frame_num = first_image + i * cols + j - 1
+                return frame_num
 
-    mrows = rows // mosaic_y
-    mcols = cols // mosaic_x
+        else:
 
-    if 1:
-        fcn = run_dpc
-    else:
-        fcn = xj_test
-
-    gx_factor = len(ref_fx) * pixel_size / (lambda_ * focus_to_det * 1e6)
-    gy_factor = len(ref_fy) * pixel_size / (lambda_ * focus_to_det * 1e6)
-
-    for n in range(mosaic_y):
-        for m in range(mosaic_x):
-            if use_hdf5:
-                args = [
-                    (datastack[get_filename(i, j), :, :], i, j)
-                    for i in range(n * mrows, n * mrows + mrows)
-                    for j in range(m * mcols, m * mcols + mcols)
-                ]
+            def get_filename(i, j):
+                frame_num = first_image + i * cols + j
+                return file_format % frame_num
+
+        _t0 = time.time()
+
+        mrows = rows // mosaic_y
+        mcols = cols // mosaic_x
+
+        # Tasks are segments of at most chunksize points of a scan row of a
+        # mosaic tile, whole rows by default. Batch solvers, and fits seeded from
+        # the neighboring scan point, always work on such blocks; with a
+        # chunksize of 1 the other solvers get one scan point per task.
+        if not chunksize or chunksize < 1:
+            chunksize = mcols
+        if not max_inflight or max_inflight < 1:
+            max_inflight = 1 if isinstance(executor, SerialExecutor) else 4 * (os.cpu_count() or 1)
+        batch = chunksize > 1 or solver in BATCH_SOLVERS or neighbor_start == 1
+
+        gx_factor, gy_factor = gradient_factors(nx, ny, pixel_size, focus_to_det, energy, processing_mode)
+
+        if processing_mode != "Fourier-shift":
+            n_frames = rows * cols
+
+            if reference is None:
+                # projections from the sidecar, the reference being the first
+                xline, yline = projections
+                ref_xline, ref_yline = xline[:1], yline[:1]
+            elif use_hdf5:
+                ref_xline, ref_yline = project_stack(reference)
+                xline, yline = project_hdf5(
+                    file_format,
+                    first_image - 1,
+                    first_image - 1 + n_frames,
+                    roi=roi,
+                    bad_pixels=bad_pixels,
+                    budget_mb=hdf5_budget_mb,
+                )
+            else:
+                ref_xline, ref_yline = project_stack(reference)
+                xline = np.zeros((n_frames, ref_xline.shape[1]))
+                yline = np.zeros((n_frames, ref_yline.shape[1]))
+                for idx in range(n_frames):
+                    try:
+                        img = read_image(load_image, get_filename(*divmod(idx, cols)), hang, zip_file=zip_file)
+                    except IOError as ie:
+                        print("%s" % ie)
+                        continue
+                    if img is not None:
+                        xline[idx], yline[idx] = project_stack(img, roi=roi, bad_pixels=bad_pixels)
+
+            _a, _gx, _gy = dpc_preview(xline, yline, ref_xline, ref_yline, processing_mode)
+            _a, _gx, _gy = [v.reshape(rows, cols) for v in (_a, reverse_x * _gx, reverse_y * _gy)]
+            if pyramid == 1:
+                for v in (_a, _gx, _gy):
+                    v[1::2] = v[1::2, ::-1]
+
+            a[:] = _a
+            if swap == 1:
+                gy[:] = _gx * gx_factor
+                gx[:] = _gy * gy_factor
             else:
-                args = [
-                    (get_filename(i, j), i, j)
-                    for i in range(n * mrows, n * mrows + mrows)
-                    for j in range(m * mcols, m * mcols + mcols)
-                ]
+                gx[:] = _gx * gx_factor
+                gy[:] = _gy * gy_factor
 
-            try:
+        else:
 
-                if display_fcn is not None and random == 1:
-                    np.random.shuffle(args)
-
-                # Function call without multiprocessing for debugging
-                #                 for arg in args:
-                #                     results = fcn(arg[0],arg[1],arg[2], ref_fx=ref_fx, roi=roi)
-
-                if use_hdf5:
-                    fcn = run_dpc_h5
-
-                results = [pool.apply_async(fcn, arg, kwds=dpc_settings) for arg in args]
-
-                if calculate_results:
-                    total_results = len(results)
-                    k = 0
-                    while k < total_results:
-                        k = 0
-                        for arg, result in zip(args, results):
-                            if result.ready():
-                                _a, _gx, _gy, _rx, _ry = result.get()
-                                fn, i, j = arg
-
-                                if pyramid == 1 and i % 2 != 0:
-                                    j = mcols - j - 1
-
-                                a[i, j] = _a
-                                rx[i, j] = _rx
-                                ry[i, j] = _ry
-                                if swap == 1:
-                                    gy[i, j] = _gx * gx_factor
-                                    gx[i, j] = _gy * gy_factor
-                                else:
-                                    gx[i, j] = _gx * gx_factor
-                                    gy[i, j] = _gy * gy_factor
-                                k += 1
-
-                        try:
-                            if display_fcn is not None:
-                                display_fcn(a, gx, gy, None, rx, ry)
-                        except Exception as ex:
-                            print("Failed to update display: (%s) %s" % (ex.__class__.__name__, ex))
-
-                        time.sleep(1.0)
-            except KeyboardInterrupt:
-                print("Cancelled")
-                return
-    pool.close()
-    pool.join()
+            def make_task(i, j):
+                # j is one column or, for blocks, an array of columns
+                if read_in_workers:
+                    return get_filename(i, j), i, j
+                elif use_shared_memory:
+                    return i * cols + j - frame_offset, i, j
+                elif use_hdf5:
+                    n = i * cols + j - frame_offset
+                    return (xlines[n], ylines[n]), i, j
+                elif np.ndim(j):
+                    return [get_filename(i, jj) for jj in j], i, j
+                return get_filename(i, j), i, j
+
+            def store_results(arg, values):
+                fn, i, j = arg
+                if use_shared_memory:
+                    # written in place by the worker
+                    values = shared_results[:, i, j].copy()
+                _a, _gx, _gy, _rx, _ry = values
+
+                done[i, j] = True
+                if pyramid == 1 and i % 2 != 0:
+                    j = mcols - j - 1
+
+                a[i, j] = _a
+                rx[i, j] = _rx
+                ry[i, j] = _ry
+                if swap == 1:
+                    gy[i, j] = _gx * gx_factor
+                    gx[i, j] = _gy * gy_factor
+                else:
+                    gx[i, j] = _gx * gx_factor
+                    gy[i, j] = _gy * gy_factor
+
+            def update_display():
+                nonlocal last_display
+                last_display = time.time()
+                try:
+                    display_fcn(a, gx, gy, None, rx, ry)
+                except Exception as ex:
+                    print("Failed to update display: (%s) %s" % (ex.__class__.__name__, ex))
+
+            def write_checkpoint():
+                nonlocal last_checkpoint, checkpoint_failed
+                last_checkpoint = time.time()
+                try:
+                    save_checkpoint(checkpoint, checkpoint_key, done, a, gx, gy, rx, ry)
+                except Exception as ex:
+                    # reported once, not at every interval
+                    if not checkpoint_failed:
+                        print(
+                            "Failed to save checkpoint %s, the fit cannot be resumed: (%s) %s"
+                            % (checkpoint, ex.__class__.__name__, ex)
+                        )
+                    checkpoint_failed = True
+                else:
+                    checkpoint_failed = False
+
+            last_display = last_checkpoint = time.time()
+            checkpoint_failed = False
+
+            for n in range(mosaic_y):
+                for m in range(mosaic_x):
+                    if batch:
+                        js = np.arange(m * mcols, m * mcols + mcols)
+                        cells = [
+                            (i, js[k : k + chunksize])
+                            for i in range(n * mrows, n * mrows + mrows)
+                            for k in range(0, mcols, chunksize)
+                        ]
+                    else:
+                        cells = [
+                            (i, j)
+                            for i in range(n * mrows, n * mrows + mrows)
+                            for j in range(m * mcols, m * mcols + mcols)
+                        ]
+                    # skip the points restored from a checkpoint
+                    cells = [(i, j[~done[i, j]]) if np.ndim(j) else (i, j) for i, j in cells]
+                    cells = [(i, j) for i, j in cells if not np.all(done[i, j])]
+
+                    try:
+
+                        if display_fcn is not None and random == 1:
+                            np.random.shuffle(cells)
+
+                        # Function call without multiprocessing for debugging
+                        #                 for arg in args:
+                        #                     results = fcn(arg[0],arg[1],arg[2], ref_fx=ref_fx, roi=roi)
+
+                        tasks = (make_task(i, j) for i, j in cells)
+                        for arg, _results in imap_bounded(
+                            executor, run_dpc_frames, tasks, dpc_settings, max_inflight
+                        ):
+                            if not calculate_results:
+                                continue
+                            store_results(arg, _results)
+
+                            if display_fcn is not None and time.time() - last_display >= display_interval:
+                                update_display()
+                            if checkpoint and time.time() - last_checkpoint >= checkpoint_interval:
+                                write_checkpoint()
+
+                        if checkpoint and cells:
+                            write_checkpoint()
+                        if display_fcn is not None:
+                            update_display()
+                    except KeyboardInterrupt:
+                        print("Cancelled")
+                        if checkpoint:
+                            write_checkpoint()
+                        return
+        completed = True
+    finally:
+        # also when a task fails, which would otherwise leave the workers
+        # running and the blocks behind in /dev/shm; the arrays viewing the
+        # blocks are dropped first
+        if owned:
+            executor.shutdown(wait=completed)
+        shared_results = None
+        release_shared_arrays(shm_stack, shm_results)
 
     _t1 = time.time()
     elapsed = _t1 - _t0
@@ -639,29 +2448,37 @@ def main(
         "" % (elapsed, rows * cols, 1000 * elapsed / (rows * cols))
     )
 
-    dim = len(np.squeeze(gx).shape)
-    if dim != 1:
-        if pad is True:
-            phi = recon(gx, gy, dx, dy, 3)
-            print("Padding mode enabled!")
-        else:
-            phi = recon(gx, gy, dx, dy)
-            print("Padding mode disabled!")
-        t1 = time.time()
-        print("Elapsed", t1 - t0)
-
-        if display_fcn is not None:
-            display_fcn(a, gx, gy, phi, rx, ry)
-        return a, gx, gy, phi, rx, ry
-
-    else:
-        t1 = time.time()
-        print("Elapsed", t1 - t0)
+    # the residuals of the fits of gx and gy
+    res_x, res_y = (ry, rx) if swap == 1 else (rx, ry)
+    phi = recon_maps(gx, gy, dx, dy, pad, res_x, res_y, a, recon_tol, recon_max_iters)
+    if raw_results:
+        # to regenerate the results for other geometry, see rescale_results
+        save_raw_results(
+            raw_results,
+            a,
+            gx,
+            gy,
+            rx,
+            ry,
+            nx,
+            ny,
+            processing_mode,
+            pixel_size=pixel_size,
+            focus_to_det=focus_to_det,
+            energy=energy,
+            swap=swap,
+            reverse_x=reverse_x,
+            reverse_y=reverse_y,
+            dx=dx,
+            dy=dy,
+            pad=pad,
+        )
+    t1 = time.time()
+    print("Elapsed", t1 - t0)
 
-        phi = None
-        if display_fcn is not None:
-            display_fcn(a, gx, gy, phi, rx, ry)
-        return a, gx, gy, phi, rx, ry
+    if display_fcn is not None:
+        display_fcn(a, gx, gy, phi, rx, ry)
+    return a, gx, gy, phi, rx, ry
 
 
 if __name__ == "__main__":
@@ -0,0 +1,55 @@
+import h5py
+import numpy as np
+import pytest
+
+from dpcmaps import dpc_kernel
+
+
+def _frame(n=64, shift_x=0.0, shift_y=0.0, amp=1.0):
+    """Synthetic diffraction frame: a structured spot translated by ``(shift_x, shift_y)`` pixels"""
+    y, x = np.mgrid[:n, :n] - n / 2
+    spot = np.exp(-(x**2 + y**2) / (2 * 5.0**2)) * (1 + 0.5 * np.cos(x / 2.0) * np.sin(y / 3.0))
+    kx = np.fft.fftfreq(n)[np.newaxis, :]
+    ky = np.fft.fftfreq(n)[:, np.newaxis]
+    shifted = np.fft.ifft2(np.fft.fft2(spot) * np.exp(-2j * np.pi * (kx * shift_x + ky * shift_y)))
+    return amp * shifted.real
+
+
+@pytest.fixture
+def hdf5_scan(tmp_path):
+    """4 x 5 scan in an HDF5 file; the first frame is the reference. Returns the path and the x/y shifts"""
+    rng = np.random.default_rng(0)
+    shifts = rng.uniform(-3.0, 3.0, (2, 4, 5))
+    shifts[:, 0, 0] = 0.0
+    frames = [_frame(shift_x=sx, shift_y=sy) for sx, sy in zip(shifts[0].ravel(), shifts[1].ravel())]
+
+    file_path = str(tmp_path / "scan.h5")
+    with h5py.File(file_path, "w") as f:
+        f.create_dataset("entry/instrument/detector/data", data=np.array(frames))
+    return file_path, shifts
+
+
+# Gradient of a shift of one pixel in the scans of the tests: 2 * pi * shift / L
+# * L * pixel_size / (lambda * focus_to_det * 1e6), lambda = 1e-4 um
+SCALE = 2 * np.pi / 100
+
+
+def _main(file_path, **options):
+    """dpc_kernel.main on the scan of hdf5_scan with the geometry of SCALE; the options override the defaults"""
+    settings = dict(
+        file_format=file_path,
+        rows=4,
+        cols=5,
+        mosaic_x=1,
+        mosaic_y=1,
+        energy=12.4,
+        focus_to_det=1.0,
+        pixel_size=1.0,
+        first_image=1,
+        use_hdf5=True,
+        solver="Levenberg-Marquardt",
+        executor="serial",
+        calculate_results=True,
+    )
+    settings.update(options)
+    return dpc_kernel.main(**settings)
@@ -0,0 +1,260 @@
+import os
+import threading
+import time
+
+import h5py
+import numpy as np
+import pytest
+
+from dpcmaps import dpc_batch, dpc_kernel
+from dpcmaps.tests.conftest import _frame
+
+
+@pytest.fixture
+def batch_script(tmp_path):
+    """Script and parameter files for a batch of three 3 x 4 scans; returns the script path and the x shifts"""
+    rng = np.random.default_rng(1)
+    shifts = rng.uniform(-2.0, 2.0, (3, 3, 4))
+    shifts[:, 0, 0] = 0.0
+    for scan, scan_shifts in zip((7, 8, 9), shifts):
+        with h5py.File(str(tmp_path / "S{0}.h5".format(scan)), "w") as f:
+            frames = [_frame(shift_x=shift, shift_y=-0.5 * shift) for shift in scan_shifts.ravel()]
+            f.create_dataset("entry/instrument/detector/data", data=np.array(frames))
+
+    params = tmp_path / "params.txt"
+    params.write_text(
+        "step_size_dx_um = 0.1\n"
+        "step_size_dy_um = 0.1\n"
+        "cols_x = 4\n"
+        "rows_y = 3\n"
+        "pixel_size_um = 1.0\n"
+        "detector_sample_distance = 1.0\n"
+        "energy_keV = 12.4\n"
+        "solver = Levenberg-Marquardt\n"
+        "random = -1\n"
+    )
+    script = tmp_path / "script.txt"
+    script.write_text(
+        "scan_range = 7-9\n"
+        "data_directory = {0}\n"
+        "file_format = S{{0}}.h5\n"
+        "parameter_file = {1}\n"
+        "processes = 2\n"
+        "save_path = {0}\n"
+        "save_filename = results\n"
+        "save_pngs = 1\n"
+        "save_txt = 1\n".format(tmp_path, params)
+    )
+    return str(script), shifts
+
+
+@pytest.mark.parametrize(
+    "options",
+    [
+        "",
+        "pipeline = 1\n",
+        "concurrent_scans = 2\n",
+        "pipeline = 1\nconcurrent_scans = 0\nread_in_workers = 1\n",
+        "concurrent_scans = 3\nmemory_limit_mb = 1\n",
+        "checkpoint = 1\npad = DCT\n",
+        "pad = Weighted\n",
+        "pipeline = 1\nprojection_cache = 1\n",
+    ],
+)
+def test_run_batch(batch_script, monkeypatch, options):
+    script, shifts = batch_script
+    save_path = script.rsplit("/", 1)[0]
+    with open(save_path + "/params.txt", "a") as f:
+        f.write(options)
+
+    executors = []
+    make_executor = dpc_batch.make_executor
+
+    def counting_make_executor(*args, **kwargs):
+        executors.append(make_executor(*args, **kwargs)[0])
+        return executors[-1], True
+
+    monkeypatch.setattr(dpc_batch, "make_executor", counting_make_executor)
+
+    dpc_batch.run_batch(script)
+
+    # one executor for the whole batch
+    assert len(executors) == 1
+    for scan, scan_shifts in zip((7, 8, 9), shifts):
+        gx = np.loadtxt("{0}/S{1}_results_gx.txt".format(save_path, scan))
+        assert gx == pytest.approx(2 * np.pi / 100 * scan_shifts, abs=1e-4)
+        assert os.path.exists("{0}/S{1}_results_phi.png".format(save_path, scan))
+        checkpoint = "{0}/S{1}_results_checkpoint.npz".format(save_path, scan)
+        assert os.path.exists(checkpoint) == ("checkpoint" in options)
+        sidecar = "{0}/S{1}_projections.h5".format(save_path, scan)
+        assert os.path.exists(sidecar) == ("projection_cache" in options)
+
+
+def test_fit_scans_memory_limit(monkeypatch):
+    lock = threading.Lock()
+    running = []
+    overlap = []
+
+    def fit_scan(scan_number, settings):
+        with lock:
+            running.append(scan_number)
+            overlap.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.remove(scan_number)
+        return scan_number, None
+
+    # 400 MB per scan: two of them fit in 1000 MB
+    monkeypatch.setattr(dpc_batch, "fit_scan", fit_scan)
+    monkeypatch.setattr(dpc_batch, "scan_memory", lambda settings: (400 * 2**20, 1))
+    monkeypatch.setattr(dpc_batch, "scan_frame_bytes", lambda settings: (0, 0))
+    settings = dict(rows=1, cols=1, chunksize=0, max_inflight=0, use_shared_memory=-1, read_in_workers=-1)
+    jobs = [(n, dict(settings)) for n in range(6)]
+
+    done = [n for n, _ in dpc_batch.fit_scans(jobs, workers=8, concurrent_scans=4, memory_limit_mb=1000)]
+
+    assert sorted(done) == list(range(6))
+    assert max(overlap) == 2
+    assert jobs[0][1]["max_inflight"] == 8
+
+
+@pytest.mark.parametrize("read_in_workers", [-1, 1])
+def test_fit_scans_sizes_each_scan(tmp_path, monkeypatch, read_in_workers):
+    # 4 x 5 scans of 32 kB and of 2 MB frames
+    jobs = []
+    for scan, size in ((1, 64), (2, 512)):
+        file_path = str(tmp_path / "S{0}.h5".format(scan))
+        with h5py.File(file_path, "w") as f:
+            f.create_dataset("entry/instrument/detector/data", shape=(20, size, size), dtype="f8")
+        settings = dict(
+            file_format=file_path,
+            use_hdf5=True,
+            rows=4,
+            cols=5,
+            chunksize=0,
+            max_inflight=0,
+            hdf5_budget_mb=1024,
+            use_shared_memory=-1,
+            read_in_workers=read_in_workers,
+        )
+        jobs.append((scan, settings))
+
+    fitted = {}
+
+    def fit_scan(scan_number, settings):
+        fitted[scan_number] = dict(settings)
+        return scan_number, None
+
+    monkeypatch.setattr(dpc_batch, "fit_scan", fit_scan)
+    list(dpc_batch.fit_scans(jobs, workers=4, concurrent_scans=2, memory_limit_mb=24))
+
+    small, large = fitted[1], fitted[2]
+    # the small scan fits whole rows with its share of the workers
+    assert small["chunksize"] == 0 and small["max_inflight"] == 8
+    if read_in_workers == 1:
+        # the workers hold the 2 MB frames of the tasks in flight
+        assert large["chunksize"] == 1 and large["max_inflight"] == 4
+    else:
+        # the tasks carry projections, and the main process reads the whole
+        # small scan at once, but a quarter of the share of the large one
+        assert large["chunksize"] == 0 and large["max_inflight"] == 8
+        assert small["hdf5_budget_mb"] == pytest.approx(20 * 64 * 64 * 8 / 2**20)
+        assert large["hdf5_budget_mb"] == pytest.approx(3.0)
+    for settings in (small, large):
+        assert dpc_batch.scan_memory(settings)[0] <= 12 * 2**20
+
+
+@pytest.mark.parametrize(
+    "value, mode",
+    [
+        ("Fourier", "Fourier"),
+        ("Fourier-padded", "Fourier-padded"),
+        ("dct", "DCT"),
+        ("Weighted", "Weighted"),
+        ("1", "Fourier-padded"),
+        ("0", "Fourier"),
+        ("-1", "Fourier"),
+    ],
+)
+def test_read_scan_parameters_pad(tmp_path, value, mode):
+    param_file = str(tmp_path / "params.txt")
+    with open(param_file, "w") as f:
+        f.write("energy_keV = 12.4\npad = {0}\nrecon_tol = 1e-4\nrecon_max_iters = 80\nrows_y = 3\n".format(value))
+
+    scan_parameters = dpc_batch.read_scan_parameters_from_file(dpc_batch.init_scan_parameters(), param_file)
+    assert scan_parameters["pad"] == mode
+    assert scan_parameters["recon_tol"] == 1e-4 and scan_parameters["recon_max_iters"] == 80
+    assert scan_parameters["energy"] == 12.4 and scan_parameters["rows"] == 3
+
+
+def test_run_batch_result_cache(batch_script, monkeypatch):
+    script, shifts = batch_script
+    save_path = script.rsplit("/", 1)[0]
+    with open(save_path + "/params.txt", "a") as f:
+        f.write("result_cache = 1\n")
+
+    fitted = []
+    main = dpc_batch.dpc_kernel_main
+
+    def counting_main(**settings):
+        fitted.append(settings["scan"])
+        return main(**settings)
+
+    monkeypatch.setattr(dpc_batch, "dpc_kernel_main", counting_main)
+
+    dpc_batch.run_batch(script)
+    assert sorted(fitted) == [7, 8, 9]
+
+    # unchanged scans are not fitted again, and their results are saved
+    os.remove("{0}/S8_results_gx.txt".format(save_path))
+    del fitted[:]
+    dpc_batch.run_batch(script)
+    assert fitted == []
+    gx = np.loadtxt("{0}/S8_results_gx.txt".format(save_path))
+    assert gx == pytest.approx(2 * np.pi / 100 * shifts[1], abs=1e-4)
+
+    # the results of a scan with new data are not reused
+    with h5py.File("{0}/S9.h5".format(save_path), "r") as f:
+        frames = f["entry/instrument/detector/data"][()]
+    with h5py.File("{0}/S9_new.h5".format(save_path), "w") as f:
+        f.create_dataset("entry/instrument/detector/data", data=frames + 1)
+    os.replace("{0}/S9_new.h5".format(save_path), "{0}/S9.h5".format(save_path))
+    dpc_batch.run_batch(script)
+    assert fitted == [9]
+
+
+def test_run_batch_pipeline_resumes_from_checkpoint(batch_script, monkeypatch):
+    script, shifts = batch_script
+    save_path = script.rsplit("/", 1)[0]
+    with open(save_path + "/params.txt", "a") as f:
+        f.write("pipeline = 1\ncheckpoint = 1\n")
+    dpc_batch.run_batch(script)
+
+    # every scan is restored from its checkpoint: neither the read-ahead nor
+    # main reads a frame
+    os.remove("{0}/S8_results_gx.txt".format(save_path))
+    monkeypatch.setattr(dpc_batch, "project_hdf5", None)
+    monkeypatch.setattr(dpc_kernel, "project_hdf5", None)
+    dpc_batch.run_batch(script)
+    gx = np.loadtxt("{0}/S8_results_gx.txt".format(save_path))
+    assert gx == pytest.approx(2 * np.pi / 100 * shifts[1], abs=1e-4)
+
+
+def test_run_rescale(batch_script):
+    script, shifts = batch_script
+    save_path = script.rsplit("/", 1)[0]
+    with open(save_path + "/params.txt", "a") as f:
+        f.write("save_raw = 1\n")
+    dpc_batch.run_batch(script)
+
+    # a corrected energy, and flipped x gradients
+    with open(save_path + "/params.txt", "a") as f:
+        f.write("energy_keV = 6.2\nreverse_x = -1\n")
+    # the data is not read again
+    for scan in (7, 8, 9):
+        os.remove("{0}/S{1}.h5".format(save_path, scan))
+    dpc_batch.run_rescale(script)
+
+    for scan, scan_shifts in zip((7, 8, 9), shifts):
+        gx = np.loadtxt("{0}/S{1}_results_gx.txt".format(save_path, scan))
+        assert gx == pytest.approx(-np.pi / 100 * scan_shifts, abs=1e-4)
@@ -0,0 +1,482 @@
+import multiprocessing as mp
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import h5py
+import numpy as np
+import pytest
+
+from dpcmaps import dpc_kernel
+from dpcmaps.tests.conftest import _frame, _main, SCALE
+
+
+@pytest.mark.parametrize("solver", ["Levenberg-Marquardt", "Variable-Projection"])
+@pytest.mark.parametrize("shift", [0.3, 2.5, -4.2])
+def test_fit_shift_matches_nelder_mead(solver, shift):
+    _, ref_fx, _ = dpc_kernel.load_file_h5(_frame())
+    _, fx, _ = dpc_kernel.load_file_h5(_frame(shift_x=shift, amp=1.2))
+
+    v_nm, f_nm = dpc_kernel.fit_shift(ref_fx, fx, solver="Nelder-Mead")
+    v, f = dpc_kernel.fit_shift(ref_fx, fx, solver=solver)
+
+    assert v[1] == pytest.approx(2 * np.pi * shift / 64, abs=1e-6)
+    assert v == pytest.approx(v_nm, abs=1e-4)
+    assert f <= f_nm + 1e-9
+
+
+def test_fit_varpro_large_shift():
+    _, ref_fx, _ = dpc_kernel.load_file_h5(_frame())
+    _, fx, _ = dpc_kernel.load_file_h5(_frame(shift_x=-20.2))
+
+    v, _ = dpc_kernel.fit_shift(ref_fx, fx, solver="Variable-Projection")
+    assert v[1] == pytest.approx(2 * np.pi * -20.2 / 64, abs=1e-6)
+
+
+def test_fit_newton_block_matches_per_frame_fit():
+    shifts = [0.0, 0.4, -1.3, 3.7, -12.6]
+    _, ref_fx, _ = dpc_kernel.load_file_h5(_frame())
+    fx = np.array([dpc_kernel.load_file_h5(_frame(shift_x=shift, amp=0.8))[1] for shift in shifts])
+
+    v, fun = dpc_kernel.fit_shift_block(ref_fx, fx, solver="Batch-Newton")
+
+    for n, row in enumerate(fx):
+        v_lm, f_lm = dpc_kernel.fit_shift(ref_fx, row, solver="Levenberg-Marquardt")
+        assert v[n] == pytest.approx(v_lm, abs=1e-6)
+        assert fun[n] == pytest.approx(f_lm, abs=1e-9)
+    assert v[:, 1] == pytest.approx(2 * np.pi * np.array(shifts) / 64, abs=1e-6)
+
+
+@pytest.mark.parametrize("shift", [0.0, 0.37, -2.81, 17.45])
+def test_phase_correlation(shift):
+    _, ref_fx, _ = dpc_kernel.load_file_h5(_frame())
+    _, fx, _ = dpc_kernel.load_file_h5(_frame(shift_x=shift, amp=1.5))
+
+    v, _ = dpc_kernel.fit_shift(ref_fx, fx, solver="Phase-Correlation")
+    assert v[1] == pytest.approx(2 * np.pi * shift / 64, abs=2 * np.pi * 0.01 / 64)
+    assert v[0] == pytest.approx(1.5, rel=1e-3)
+
+    v_init, _ = dpc_kernel.fit_shift(ref_fx, fx, solver="Nelder-Mead", phase_corr_init=True)
+    assert v_init[1] == pytest.approx(2 * np.pi * shift / 64, abs=1e-5)
+
+
+def test_fit_shift_block_neighbor_start():
+    # Smoothly varying shifts with one jump that defeats the warm start
+    shifts = np.concatenate([np.linspace(1.0, 3.0, 6), np.linspace(-15.0, -14.0, 4)])
+    _, ref_fx, _ = dpc_kernel.load_file_h5(_frame())
+    fx = np.array([dpc_kernel.load_file_h5(_frame(shift_x=shift))[1] for shift in shifts])
+
+    v, _ = dpc_kernel.fit_shift_block(ref_fx, fx, solver="Nelder-Mead", phase_corr_init=True, neighbor_start=True)
+    assert v[:, 1] == pytest.approx(2 * np.pi * shifts / 64, abs=1e-5)
+
+
+def test_project_stack_matches_load_file_h5():
+    stack = np.array([_frame(shift_x=shift) for shift in (0.0, 1.5, -2.0)])
+    roi = (5, 8, 50, 60)
+    bad_pixels = [(10, 20), (30, 9), (10, 20)]
+
+    xline, yline = dpc_kernel.project_stack(stack, roi=roi, bad_pixels=bad_pixels)
+
+    for n, frame in enumerate(stack):
+        im, fx, fy = dpc_kernel.load_file_h5(frame.copy(), roi=roi, bad_pixels=bad_pixels)
+        assert xline[n] == pytest.approx(np.sum(im, axis=0))
+        assert yline[n] == pytest.approx(np.sum(im, axis=1))
+
+
+def test_project_hdf5_streams_chunk_aligned_blocks(tmp_path):
+    stack = np.array([_frame(shift_x=0.1 * n) for n in range(23)])
+    file_path = str(tmp_path / "chunked.h5")
+    with h5py.File(file_path, "w") as f:
+        f.create_dataset("entry/instrument/detector/data", data=stack, chunks=(4, 64, 64))
+
+    # 10 frames of 32 kB fit in the budget: blocks of two chunks
+    budget_mb = 10 * 64 * 64 * 8 / 2**20
+    with h5py.File(file_path, "r") as f:
+        blocks = dpc_kernel.hdf5_frame_blocks(f["entry/instrument/detector/data"], 3, 21, budget_mb)
+    assert blocks == [(3, 8), (8, 16), (16, 21)]
+
+    roi = (5, 8, 50, 60)
+    xline, yline = dpc_kernel.project_hdf5(file_path, 3, 21, roi=roi, bad_pixels=[(10, 20)], budget_mb=budget_mb)
+    ref_xline, ref_yline = dpc_kernel.project_stack(stack[3:21], roi=roi, bad_pixels=[(10, 20)])
+    assert xline == pytest.approx(ref_xline)
+    assert yline == pytest.approx(ref_yline)
+
+
+def test_load_frames_hdf5_keeps_file_open(hdf5_scan):
+    file_path, _ = hdf5_scan
+    frame = dpc_kernel.load_frames_hdf5(file_path, 3)
+    dsdata = dpc_kernel.open_hdf5_cached(file_path)
+
+    assert frame == pytest.approx(dsdata[3])
+    assert dpc_kernel.load_frames_hdf5(file_path, 2, 4).shape == (2, 64, 64)
+    assert dpc_kernel.open_hdf5_cached(file_path).file.id == dsdata.file.id
+
+
+def test_open_hdf5_cached_closes_least_recently_used(tmp_path, monkeypatch):
+    monkeypatch.setattr(dpc_kernel, "HDF5_MAX_OPEN_FILES", 2)
+    paths = []
+    for n in range(3):
+        paths.append(str(tmp_path / ("scan_%d.h5" % n)))
+        with h5py.File(paths[-1], "w") as f:
+            f.create_dataset("entry/instrument/detector/data", data=np.full((2, 4, 4), n))
+
+    datasets = [dpc_kernel.open_hdf5_cached(path) for path in paths[:2]]
+    dpc_kernel.open_hdf5_cached(paths[0])
+    dpc_kernel.open_hdf5_cached(paths[2])
+
+    # the second file was the least recently used
+    assert datasets[0].id.valid and not datasets[1].id.valid
+    assert list(dpc_kernel.hdf5_files) == [paths[0], paths[2]]
+    assert dpc_kernel.open_hdf5_cached(paths[0]).file.id == datasets[0].file.id
+
+
+def test_dpc_preview_com_matches_fit():
+    shifts = [(0.5, -1.0), (2.0, 3.5), (-4.0, 0.25)]
+    stack = np.array([_frame(shift_x=sx, shift_y=sy, amp=2.0) for sx, sy in shifts])
+    ref_xline, ref_yline = dpc_kernel.project_stack(_frame())
+    xline, yline = dpc_kernel.project_stack(stack)
+
+    a, sx, sy = dpc_kernel.dpc_preview(xline, yline, ref_xline, ref_yline, "COM")
+
+    assert a == pytest.approx(2.0)
+    assert sx == pytest.approx(2 * np.pi * np.array([s[0] for s in shifts]) / 64, abs=1e-6)
+    assert sy == pytest.approx(2 * np.pi * np.array([s[1] for s in shifts]) / 64, abs=1e-6)
+
+
+def test_stack_spectra_matches_load_file_h5():
+    stack = np.array([_frame(shift_x=shift, shift_y=-shift) for shift in (0.0, 0.7, 3.2)])
+    roi = (2, 3, 60, 61)
+
+    fx, fy = dpc_kernel.stack_spectra(stack, roi=roi, bad_pixels=[(4, 5)])
+
+    for n, frame in enumerate(stack):
+        _, fx_n, fy_n = dpc_kernel.load_file_h5(frame.copy(), roi=roi, bad_pixels=[(4, 5)])
+        assert fx[n] == pytest.approx(fx_n)
+        assert fy[n] == pytest.approx(fy_n)
+
+
+@pytest.mark.parametrize("frames", [3, np.array([1, 2, 3])])
+def test_run_dpc_frames_sources_agree(hdf5_scan, tmp_path, frames):
+    file_path, shifts = hdf5_scan
+    with h5py.File(file_path, "r") as f:
+        stack = f["entry/instrument/detector/data"][()]
+    filenames = []
+    for n, frame in enumerate(stack):
+        filenames.append(str(tmp_path / ("frame_%d.npy" % n)))
+        np.save(filenames[-1], frame)
+
+    _, ref_fx, ref_fy = dpc_kernel.load_file_h5(stack[0])
+    settings = dict(ref_fx=ref_fx, ref_fy=ref_fy, solver="Batch-Newton")
+    xline, yline = dpc_kernel.project_stack(stack[frames])
+    names = filenames[frames] if np.ndim(frames) == 0 else [filenames[n] for n in frames]
+
+    expected = dpc_kernel.run_dpc_frames(names, 0, frames, load_image=np.load, hang=0, **settings)
+    assert np.shape(expected) == (5,) + np.shape(frames)
+    for source, task in [("lines", (np.squeeze(xline), np.squeeze(yline))), ("hdf5", frames)]:
+        results = dpc_kernel.run_dpc_frames(task, 0, frames, source=source, file_path=file_path, **settings)
+        assert np.array(results) == pytest.approx(np.array(expected))
+
+
+def test_run_dpc_wrappers(hdf5_scan, tmp_path):
+    file_path, shifts = hdf5_scan
+    stack = dpc_kernel.load_data_hdf5(file_path)
+    assert stack.shape == (20, 64, 64)
+    filename = str(tmp_path / "frame.npy")
+    np.save(filename, stack[7])
+
+    _, ref_fx, ref_fy = dpc_kernel.load_file_h5(stack[0])
+    settings = dict(ref_fx=ref_fx, ref_fy=ref_fy, solver="Batch-Newton")
+    expected = dpc_kernel.run_dpc_frames(filename, 1, 2, load_image=np.load, hang=0, **settings)
+
+    # the geometry arguments of the former workers are still accepted
+    a, gx, gy, rx, ry = dpc_kernel.run_dpc(filename, 1, 2, load_image=np.load, hang=0, energy=12.4, **settings)
+    assert (a, gx, gy, rx, ry) == pytest.approx(expected)
+    assert gx == pytest.approx(2 * np.pi * shifts[0, 1, 2] / 64, abs=1e-6)
+    assert dpc_kernel.run_dpc_h5(stack[7], 1, 2, energy=12.4, **settings) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("frames_to_workers", [{}, {"use_shared_memory": 1}, {"read_in_workers": 1}])
+@pytest.mark.parametrize("solver", ["Nelder-Mead", "Batch-Newton"])
+def test_main_hdf5(hdf5_scan, solver, frames_to_workers):
+    file_path, shifts = hdf5_scan
+    a, gx, gy, phi, rx, ry = _main(
+        file_path, solver=solver, executor="processes", pool=mp.Pool(2), **frames_to_workers
+    )
+    assert gx == pytest.approx(SCALE * shifts[0], abs=1e-4)
+    assert gy == pytest.approx(SCALE * shifts[1], abs=1e-4)
+    assert a == pytest.approx(1.0, abs=1e-5)
+    assert phi.shape == (4, 5)
+
+
+def test_main_display_is_rate_limited(hdf5_scan):
+    file_path, shifts = hdf5_scan
+    calls = []
+
+    def display(a, gx, gy, phi, rx, ry):
+        calls.append((gx.copy(), phi))
+
+    _main(file_path, executor="processes", pool=mp.Pool(2), display_fcn=display, display_interval=60.0)
+    # once when the map is complete, once more with the phase
+    assert len(calls) == 2
+    assert calls[0][0] == pytest.approx(SCALE * shifts[0], abs=1e-4)
+    assert calls[0][1] is None and calls[1][1] is not None
+
+
+@pytest.mark.parametrize("chunksize, max_inflight", [(1, 3), (2, 1), (3, 0)])
+def test_main_hdf5_chunks(hdf5_scan, chunksize, max_inflight):
+    file_path, shifts = hdf5_scan
+    a, gx, gy, phi, rx, ry = _main(
+        file_path, executor="processes", pool=mp.Pool(2), chunksize=chunksize, max_inflight=max_inflight
+    )
+    assert gx == pytest.approx(SCALE * shifts[0], abs=1e-4)
+    assert gy == pytest.approx(SCALE * shifts[1], abs=1e-4)
+
+
+@pytest.mark.parametrize(
+    "executor, processes", [("serial", None), ("threads", 2), ("processes", 2), ("processes", 0)]
+)
+def test_main_executors(hdf5_scan, executor, processes):
+    file_path, shifts = hdf5_scan
+    a, gx, gy, phi, rx, ry = _main(file_path, executor=executor, processes=processes, read_in_workers=1)
+    assert gx == pytest.approx(SCALE * shifts[0], abs=1e-4)
+    assert gy == pytest.approx(SCALE * shifts[1], abs=1e-4)
+
+
+def test_imap_bounded_cancels_pending_tasks():
+    started = []
+
+    def task(n):
+        started.append(n)
+        if n == 0:
+            raise ValueError("task %d failed" % n)
+        time.sleep(0.05)
+
+    with ThreadPoolExecutor(1) as executor:
+        with pytest.raises(ValueError):
+            for _ in dpc_kernel.imap_bounded(executor, task, [(n,) for n in range(10)], {}, 4):
+                pass
+    # the failed task, and at most the one which started while it was reported
+    assert len(started) <= 2
+
+
+@pytest.mark.skipif(not os.path.isdir("/dev/shm"), reason="shared memory blocks are not listed in /dev/shm")
+def test_main_releases_shared_memory_on_error(hdf5_scan):
+    file_path, shifts = hdf5_scan
+    blocks = set(os.listdir("/dev/shm"))
+    with pytest.raises(Exception):
+        _main(file_path, solver="bogus", use_shared_memory=1, executor="processes", processes=2)
+    assert set(os.listdir("/dev/shm")) <= blocks
+
+
+def test_main_resumes_from_checkpoint(hdf5_scan, tmp_path, monkeypatch):
+    file_path, shifts = hdf5_scan
+    checkpoint = str(tmp_path / "scan_checkpoint.npz")
+    _main(file_path, checkpoint=checkpoint)
+    with np.load(checkpoint) as data:
+        assert data["done"].all()
+        saved = dict(data)
+
+    # Mark the last two rows as missing and tag the first two: only the
+    # missing points are read and fitted again
+    saved["done"][2:] = False
+    saved["gx"][:2] = 123.0
+    saved = {k: saved[k] for k in ("key", "done", "a", "gx", "gy", "rx", "ry")}
+    dpc_kernel.save_checkpoint(checkpoint, **saved)
+    spans = []
+    project_hdf5 = dpc_kernel.project_hdf5
+
+    def project_span(file_path, start, stop, **kwargs):
+        spans.append((start, stop))
+        return project_hdf5(file_path, start, stop, **kwargs)
+
+    with monkeypatch.context() as m:
+        m.setattr(dpc_kernel, "project_hdf5", project_span)
+        a, gx, gy, phi, rx, ry = _main(file_path, checkpoint=checkpoint)
+    assert spans == [(10, 20)]
+    assert np.all(gx[:2] == 123.0)
+    assert gx[2:] == pytest.approx(SCALE * shifts[0][2:], abs=1e-4)
+
+    dpc_kernel.save_checkpoint(checkpoint, **saved)
+    a, gx, gy, phi, rx, ry = _main(
+        file_path, checkpoint=checkpoint, executor="processes", processes=2, use_shared_memory=1
+    )
+    assert np.all(gx[:2] == 123.0)
+    assert gx[2:] == pytest.approx(SCALE * shifts[0][2:], abs=1e-4)
+
+    # a complete checkpoint: no frame is read
+    with monkeypatch.context() as m:
+        for name in ("project_hdf5", "load_frames_hdf5", "load_data_hdf5_shared"):
+            m.setattr(dpc_kernel, name, None)
+        a, gx_restored, gy, phi, rx, ry = _main(file_path, checkpoint=checkpoint)
+    assert np.all(gx_restored == gx)
+
+    # a checkpoint of other settings is not used
+    a, gx, gy, phi, rx, ry = _main(file_path, checkpoint=checkpoint, energy=6.2)
+    assert gx == pytest.approx(SCALE / 2 * shifts[0], abs=1e-4)
+
+
+def test_main_reports_checkpoint_failure_once(hdf5_scan, tmp_path, capsys):
+    file_path, shifts = hdf5_scan
+    checkpoint = str(tmp_path / "missing" / "scan_checkpoint.npz")
+    a, gx, gy, phi, rx, ry = _main(file_path, checkpoint=checkpoint, checkpoint_interval=0.0)
+    assert gx == pytest.approx(SCALE * shifts[0], abs=1e-4)
+    assert capsys.readouterr().out.count("Failed to save checkpoint %s" % checkpoint) == 1
+
+
+def test_rescale_results(hdf5_scan, tmp_path):
+    file_path, shifts = hdf5_scan
+    raw_path = str(tmp_path / "raw.npz")
+    _main(file_path, swap=1, raw_results=raw_path)
+    raw = dpc_kernel.load_raw_results(raw_path)
+
+    expected = _main(file_path, energy=6.2, reverse_x=-1)
+    results = dpc_kernel.rescale_results(raw, energy=6.2, swap=-1, reverse_x=-1)
+    for value, expected_value in zip(results, expected):
+        assert value == pytest.approx(expected_value, abs=1e-10)
+
+    with pytest.raises(ValueError):
+        dpc_kernel.rescale_results(raw, solver="Nelder-Mead")
+
+
+def test_main_projection_cache(hdf5_scan, tmp_path):
+    file_path, shifts = hdf5_scan
+    sidecar = str(tmp_path / "scan_projections.h5")
+    _main(file_path, solver="Nelder-Mead", projection_cache=sidecar)
+    assert dpc_kernel.load_projections(sidecar, file_path, 0, 20) is not None
+    assert dpc_kernel.load_projections(sidecar, file_path, 0, 20, roi=(0, 0, 31, 31)) is None
+    assert dpc_kernel.load_projections(sidecar, file_path, 0, 20, bad_pixels=[(3, 4)]) is None
+
+    # refitted with another solver from the sidecar alone
+    os.rename(file_path, file_path + ".moved")
+    a, gx, gy, phi, rx, ry = _main(file_path, projection_cache=sidecar)
+    assert gx == pytest.approx(SCALE * shifts[0], abs=1e-4)
+    assert gy == pytest.approx(SCALE * shifts[1], abs=1e-4)
+    a, gx, gy, phi, rx, ry = _main(file_path, processing_mode="COM", projection_cache=sidecar)
+    assert np.corrcoef(gx.ravel(), shifts[0].ravel())[0, 1] > 0.9
+
+
+def _recon_reference(gx, gy, dx, dy, pad, w):
+    """recon as first implemented: centered padding, full complex FFTs and a masked division"""
+    rows, cols = gx.shape
+    inner = (slice((pad // 2) * rows, (pad // 2 + 1) * rows), slice((pad // 2) * cols, (pad // 2 + 1) * cols))
+    gx_padding = np.zeros((pad * rows, pad * cols))
+    gy_padding = np.zeros((pad * rows, pad * cols))
+    gx_padding[inner] = gx
+    gy_padding[inner] = gy
+    tx = np.fft.fftshift(np.fft.fft2(gx_padding))
+    ty = np.fft.fftshift(np.fft.fft2(gy_padding))
+    ax = 2 * np.pi * (np.arange(pad * cols) + 1 - (pad * cols // 2 + 1)) / (pad * cols * dx)
+    ay = 2 * np.pi * (np.arange(pad * rows) + 1 - (pad * rows // 2 + 1)) / (pad * rows * dy)
+    kappax, kappay = np.meshgrid(ax, ay)
+    c = np.ma.masked_values(-1j * (kappax * tx + w * kappay * ty), 0)
+    c = np.ma.filled(c / (kappax**2 + w * kappay**2), 0)
+    c *= 1 - 0.9 * np.exp(-np.square(kappax * dx) - np.square(kappay * dy))
+    return -np.fft.ifft2(np.fft.ifftshift(c)).real[inner]
+
+
+@pytest.mark.parametrize("shape", [(20, 31), (21, 30), (17, 17)])
+@pytest.mark.parametrize("pad, w", [(1, 1.0), (3, 1.0), (1, 0.5)])
+def test_recon_matches_reference(shape, pad, w):
+    rng = np.random.default_rng(2)
+    gx, gy = rng.normal(size=(2,) + shape)
+    phi = dpc_kernel.recon(gx, gy, 0.1, 0.2, pad, w)
+    assert phi == pytest.approx(_recon_reference(gx, gy, 0.1, 0.2, pad, w), abs=1e-12)
+    assert dpc_kernel.fourier_integrator(shape, 0.1, 0.2, pad, w) is dpc_kernel.fourier_integrator(
+        shape, 0.1, 0.2, pad, w
+    )
+
+
+def test_recon_dct_is_filtered_least_squares_solution():
+    from scipy.fft import dctn, idctn
+
+    rows, cols, dx, dy, w = 5, 6, 0.1, 0.2, 0.5
+    rng = np.random.default_rng(3)
+    gx, gy = rng.normal(size=(2, rows, cols))
+
+    # finite differences between neighboring points, against the mean gradients there
+    diff_x = np.kron(np.eye(rows), np.diff(np.eye(cols), axis=0)) / dx
+    diff_y = np.kron(np.diff(np.eye(rows), axis=0), np.eye(cols)) / dy
+    mean_gx = (gx[:, 1:] + gx[:, :-1]).ravel() / 2
+    mean_gy = (gy[1:] + gy[:-1]).ravel() / 2
+    A = np.vstack([diff_x, np.sqrt(w) * diff_y])
+    b = np.concatenate([mean_gx, np.sqrt(w) * mean_gy])
+    phi = np.linalg.lstsq(A, b, rcond=None)[0].reshape(rows, cols)
+
+    kx = np.pi * np.arange(cols)[np.newaxis, :] / cols
+    ky = np.pi * np.arange(rows)[:, np.newaxis] / rows
+    f = 1 - 0.9 * np.exp(-np.square(kx) - np.square(ky))
+    f[0, 0] = 0
+    expected = -idctn(f * dctn(phi, norm="ortho"), norm="ortho")
+    assert dpc_kernel.recon_dct(gx, gy, dx, dy, w) == pytest.approx(expected, abs=1e-10)
+
+
+@pytest.mark.parametrize(
+    "pad, mode",
+    [
+        (False, "Fourier"),
+        (-1, "Fourier"),
+        (True, "Fourier-padded"),
+        (1, "Fourier-padded"),
+        ("dct", "DCT"),
+        ("weighted", "Weighted"),
+        ("true", "Fourier-padded"),
+    ],
+)
+def test_recon_mode(pad, mode):
+    assert dpc_kernel.recon_mode(pad) == mode
+
+
+def test_recon_weighted():
+    rng = np.random.default_rng(4)
+    # gradients of sin(0.8 x) cos(0.5 y), with steps of 0.1 and 0.2
+    y, x = np.mgrid[:40, :50] * np.array([0.2, 0.1])[:, np.newaxis, np.newaxis]
+    gx = 0.8 * np.cos(0.8 * x) * np.cos(0.5 * y)
+    gy = -0.5 * np.sin(0.8 * x) * np.sin(0.5 * y)
+
+    # uniform weights: the DCT integration
+    phi = dpc_kernel.recon_weighted(gx, gy, 0.1, 0.2)
+    assert phi == pytest.approx(dpc_kernel.recon_dct(gx, gy, 0.1, 0.2), abs=1e-6)
+
+    # outliers, flagged by the residuals of their fits, matter little: they
+    # keep the floor of the weights, 1 / 100 of those of good fits
+    rx, ry = np.abs(rng.normal(size=(2, 40, 50)))
+    bad = rng.random((40, 50)) < 0.02
+    bad_gx = gx + 20 * bad
+    rx[bad] = 100
+    weights = dpc_kernel.gradient_weights(rx, ry)
+    phi_weighted = dpc_kernel.recon_weighted(bad_gx, gy, 0.1, 0.2, *weights)
+    phi_unweighted = dpc_kernel.recon_dct(bad_gx, gy, 0.1, 0.2)
+    error = np.abs(phi_weighted - phi).max()
+    assert error < 0.1 * np.abs(phi_unweighted - phi).max()
+
+
+def test_recon_weighted_converges_on_outlier_map(capsys):
+    rng = np.random.default_rng(5)
+    y, x = np.mgrid[:64, :64] * 0.1
+    gx = 0.8 * np.cos(0.8 * x) * np.cos(0.5 * y)
+    gy = -0.5 * np.sin(0.8 * x) * np.sin(0.5 * y)
+    phi = dpc_kernel.recon_dct(gx, gy, 0.1, 0.1)
+
+    # 2% of failed fits, and a region where the beam is blocked, whose
+    # gradients are noise
+    rx, ry = 1 + 0.3 * np.abs(rng.normal(size=(2, 64, 64)))
+    a = 1 + 0.05 * rng.normal(size=(64, 64))
+    bad = rng.random((64, 64)) < 0.02
+    rx[bad] *= 30
+    gx = gx + rng.normal(0, 2.0, gx.shape) * bad
+    blocked = (slice(40, 52), slice(10, 30))
+    a[blocked] = 0.02
+    gx[blocked], gy[blocked] = rng.normal(0, 2.0, (2, 12, 20))
+
+    # converges within 20 iterations, without any message
+    weights = dpc_kernel.gradient_weights(rx, ry, a)
+    phi_weighted = dpc_kernel.recon_weighted(gx, gy, 0.1, 0.1, *weights, max_iters=20)
+    assert capsys.readouterr().out == ""
+    dpc_kernel.recon_maps(gx, gy, 0.1, 0.1, "Weighted", rx, ry, a, tol=1e-6, max_iters=2)
+    assert "did not converge in 2 iterations" in capsys.readouterr().out
+
+    clear = np.ones((64, 64), dtype=bool)
+    clear[blocked] = False
+    error = phi_weighted - phi
+    error_unweighted = dpc_kernel.recon_dct(gx, gy, 0.1, 0.1) - phi
+    assert np.ptp(error[clear]) < 0.5 * np.ptp(error_unweighted[clear])
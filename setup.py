@@ -50,6 +50,7 @@ setup(
             "dpcmaps = dpcmaps.dpc_gui:run_dpc_gui",
             "dpcmaps-batch = dpcmaps.dpc_batch_gui:run_dpc_batch_gui",
             "dpcmaps-script = dpcmaps.dpc_batch:run_dpc_script",
+            "dpcmaps-rescale = dpcmaps.dpc_batch:run_rescale_script",
         ],
     },
     include_package_data=True,